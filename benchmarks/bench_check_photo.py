@@ -0,0 +1,78 @@
+"""Сравнение проверки вспышки: прежний вариант (PIL _getexif и перебор всех тегов)
+и чтение только сегмента EXIF, а также проверка яркости по уменьшенной копии.
+
+Запуск из корня проекта:
+    python benchmarks/bench_check_photo.py --photos 20 --size 6000x4000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from PIL import Image
+from PIL.ExifTags import TAGS
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import check_photo, read_exif_flash, is_dark_photo
+
+
+# Реализация check_photo до перехода на разбор сегмента EXIF
+def check_photo_legacy(image_path):
+    img = Image.open(image_path)
+    exif_data = img._getexif()
+    if not exif_data:
+        return True
+    for tag, value in exif_data.items():
+        if TAGS.get(tag, tag) == "Flash":
+            return value == 9
+
+
+# Фото размера камеры с EXIF, как у снимков фотозоны
+def make_photo(path, width, height, flash=9):
+    pixels = np.random.randint(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    img = Image.fromarray(pixels).resize((width, height))
+    exif = Image.Exif()
+    exif[0x010F] = 'Canon'
+    exif[0x0110] = 'Canon EOS'
+    exif.get_ifd(0x8769)[0x9209] = flash
+    img.save(path, quality=92, exif=exif.tobytes())
+
+
+def measure(func, paths, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for path in paths:
+            func(path)
+    return (time.perf_counter() - started) / (repeat * len(paths)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--photos', type=int, default=20)
+    parser.add_argument('--size', default='6000x4000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    width, height = map(int, args.size.split('x'))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = []
+        for i in range(args.photos):
+            path = os.path.join(work_dir, f'{i:03d}.jpg')
+            make_photo(path, width, height, flash=9 if i % 2 else 16)
+            paths.append(path)
+
+        assert [check_photo(p) for p in paths] == [check_photo_legacy(p) for p in paths]
+
+        size_mb = os.path.getsize(paths[0]) / 1024 / 1024
+        print(f"{args.photos} фото {width}x{height}, {size_mb:.1f} МБ каждое")
+        print(f"{'check_photo (прежняя)':<34}{measure(check_photo_legacy, paths, args.repeat):>8.2f} мс/фото")
+        print(f"{'read_exif_flash':<34}{measure(read_exif_flash, paths, args.repeat):>8.2f} мс/фото")
+        print(f"{'check_photo':<34}{measure(check_photo, paths, args.repeat):>8.2f} мс/фото")
+        print(f"{'is_dark_photo (draft)':<34}{measure(is_dark_photo, paths, args.repeat):>8.2f} мс/фото")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Сравнение уменьшения фото для слайдшоу: полное декодирование (прежний resize_photo)
+и декодирование JPEG в уменьшенном масштабе (draft) в пуле из 1, 4 и 8 процессов.
+
+Запуск из корня проекта:
+    python benchmarks/bench_resize.py --photos 32 --size 6000x4000 --workers 1 4 8
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import resize_photo
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Реализация resize_photo до перехода на draft
+def resize_photo_legacy(image_path, save_dir, max_width=1920, max_height=1080):
+    with Image.open(image_path) as img:
+        image = ImageOps.exif_transpose(img)
+        image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+        save_path = os.path.join(save_dir, os.path.basename(image_path))
+        image.save(save_path, format='JPEG')
+        return save_path
+
+
+RESIZERS = {'legacy': resize_photo_legacy, 'draft': resize_photo}
+
+
+# Фото размера камеры; у каждого четвертого EXIF Orientation = 6 (камера повернута)
+def make_photo(path, width, height, rotated=False):
+    pixels = np.random.randint(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    img = Image.fromarray(pixels).resize((width, height))
+    exif = Image.Exif()
+    if rotated:
+        exif[0x0112] = 6
+    img.save(path, quality=92, exif=exif.tobytes())
+
+
+def peak_memory_mb():
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Выполняется в процессе пула: время обработки одного фото и пиковая память процесса
+def run_one(resizer, image_path, save_dir):
+    started = time.perf_counter()
+    RESIZERS[resizer](image_path, save_dir)
+    return time.perf_counter() - started, peak_memory_mb()
+
+
+def run_case(resizer, workers, paths, save_dir):
+    # Новый пул на каждый прогон, чтобы пиковая память не переходила между вариантами
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Прогрев: запуск процессов и импорт модулей не входят в замер
+        list(pool.map(time.sleep, [0.1] * workers))
+        started = time.perf_counter()
+        results = list(pool.map(run_one, [resizer] * len(paths), paths, [save_dir] * len(paths)))
+        wall = time.perf_counter() - started
+    per_image = sum(r[0] for r in results) / len(results) * 1000
+    peak = max(r[1] for r in results)
+    return wall, per_image, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--photos', type=int, default=32)
+    parser.add_argument('--size', default='6000x4000')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--resizers', nargs='+', default=['legacy', 'draft'], choices=list(RESIZERS))
+    args = parser.parse_args()
+    width, height = map(int, args.size.split('x'))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        photo_dir = os.path.join(work_dir, 'photo')
+        save_dir = os.path.join(work_dir, 'resized')
+        os.makedirs(photo_dir)
+        os.makedirs(save_dir)
+        paths = []
+        for i in range(args.photos):
+            path = os.path.join(photo_dir, f'{i:03d}.jpg')
+            make_photo(path, width, height, rotated=i % 4 == 0)
+            paths.append(path)
+
+        size_mb = os.path.getsize(paths[0]) / 1024 / 1024
+        print(f"{args.photos} фото {width}x{height}, {size_mb:.1f} МБ каждое, CPU: {os.cpu_count()}")
+        print(f"{'resizer':<10}{'workers':>8}{'wall, s':>10}{'photo/s':>10}{'ms/photo':>10}{'RSS, MB':>10}")
+        for workers in args.workers:
+            for resizer in args.resizers:
+                wall, per_image, peak = run_case(resizer, workers, paths, save_dir)
+                print(f"{resizer:<10}{workers:>8}{wall:>10.2f}{args.photos / wall:>10.1f}"
+                      f"{per_image:>10.0f}{peak:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
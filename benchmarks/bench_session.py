@@ -0,0 +1,254 @@
+"""Сквозной замер фотосессии: имитация камеры, кнопки бота и заглушки Telegram и Яндекс.Диска.
+
+Камера записывает N фото в наблюдаемую папку с заданной частотой, бот обрабатывает
+нажатия "Начать фотосессию" и "Получить фото в чате" / "Загрузить фото в облако"
+через Dispatcher, как при получении обновлений от Telegram. Выводятся задержка
+от записи фото до его получения сервером (перцентили), время сессии и пиковая память.
+
+Запуск из корня проекта:
+    python benchmarks/bench_session.py --photos 100 --rate 2 --mode chat
+    python benchmarks/bench_session.py --photos 100 --rate 2 --mode cloud --bandwidth 5 --json result.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from io import BytesIO
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_servers import start_fake_servers
+
+TOKEN = '123456:bench'
+USER_ID = 1000
+PHONE = '+79990000000'
+
+
+# Снимок камеры с EXIF Flash = 9 (вспышка сработала), чтобы пройти check_photo
+def make_jpeg(width, height):
+    pixels = np.random.randint(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    img = Image.fromarray(pixels).resize((width, height))
+    exif = Image.Exif()
+    exif.get_ifd(0x8769)[0x9209] = 9
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=92, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+class Camera(threading.Thread):
+    """Записывает фото в папку камеры с частотой rate в секунду.
+    Каждый файл пишется частями за write_time секунд, как при записи с карты камеры"""
+    def __init__(self, folder, data, count, rate, write_time=0.2):
+        super().__init__(daemon=True)
+        self.folder = folder
+        self.data = data
+        self.count = count
+        self.rate = rate
+        self.write_time = write_time
+        self.written = {}
+
+    def run(self):
+        started = time.monotonic()
+        parts = 4
+        step = len(self.data) // parts + 1
+        for i in range(self.count):
+            delay = started + i / self.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            name = f'IMG_{i:04d}.jpg'
+            with open(os.path.join(self.folder, name), 'wb') as f:
+                for offset in range(0, len(self.data), step):
+                    f.write(self.data[offset:offset + step])
+                    f.flush()
+                    time.sleep(self.write_time / parts)
+            self.written[name] = time.time()
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def callback_update(bot, update_id, data):
+    from aiogram.types import Update
+    return Update.model_validate({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'bench'},
+            'chat_instance': '1',
+            'data': data,
+            'message': {'message_id': update_id, 'date': int(time.time()),
+                        'chat': {'id': USER_ID, 'type': 'private'}, 'text': 'bench'},
+        },
+    }, context={'bot': bot})
+
+
+async def fetch_stats(session, url):
+    async with session.get(f'{url}/_stats') as resp:
+        return await resp.json()
+
+
+async def run_session(args, work_dir, camera_folder, telegram_url, yandex_url):
+    import aiohttp
+    import main
+    import workers
+    from utils import FileCache
+    from bench_slideshow import make_audio
+
+    # Папки бота заданы в main.py константами - переносим их во временную папку
+    main.audio_folder = os.path.join(work_dir, 'music')
+    main.slideshow_folder = os.path.join(work_dir, 'slideshow')
+    main.clients_folder = os.path.join(work_dir, 'clients')
+    main.originals_cache = FileCache(os.path.join(work_dir, 'cache'), max_files=200)
+    main.timeout = args.idle
+    os.makedirs(main.audio_folder)
+    make_audio(main.audio_folder)
+    main.dp.include_router(main.router)
+
+    photo = make_jpeg(*map(int, args.size.split('x')))
+    camera = Camera(camera_folder, photo, args.photos, args.rate, args.write_time)
+    button = 'get_photos_' if args.mode in ('chat', 'group') else 'upload_to_cloud_'
+
+    started = time.time()
+    await main.dp.feed_update(main.bot, callback_update(main.bot, 1, f'start_session_{PHONE}'))
+    photo_session = main.sessions.get(USER_ID)
+    delivery = asyncio.create_task(main.dp.feed_update(
+        main.bot, callback_update(main.bot, 2, f'{button}{PHONE}'), max_wait_time=args.idle))
+    camera.start()
+    await delivery
+    finished = time.time()
+
+    main.sessions.stop()
+    workers.get_process_pool().shutdown(wait=True)
+    workers.shutdown()
+    await main.bot.session.close()
+
+    async with aiohttp.ClientSession() as session:
+        telegram = await fetch_stats(session, telegram_url)
+        yandex = await fetch_stats(session, yandex_url)
+    print(photo_session.stats.summary())
+    return camera, photo, started, finished, telegram, yandex
+
+
+def report(args, camera, photo, started, finished, telegram, yandex):
+    from bench_slideshow import peak_memory_mb
+    deliveries = telegram['deliveries'] if args.mode in ('chat', 'group') else yandex['deliveries']
+    received = {d['name']: d['time'] for d in deliveries if d['name'] in camera.written}
+    latencies = [received[name] - written for name, written in camera.written.items() if name in received]
+    slideshow = [d for d in telegram['deliveries'] if d['name'] == 'slideshow.mp4']
+    last_written = max(camera.written.values(), default=started)
+    last_received = max(received.values(), default=finished)
+    own, children = peak_memory_mb()
+
+    result = {
+        'mode': args.mode,
+        'photos': args.photos,
+        'delivered': len(received),
+        'rate': args.rate,
+        'photo_mb': round(len(photo) / 1024 / 1024, 2),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies, default=float('nan')),
+        # От первого нажатия до получения последнего фото; без ожидания окончания сессии
+        'session_wall': last_received - started,
+        # Отставание доставки от камеры после последнего снимка
+        'drain': last_received - last_written,
+        'slideshow_after_last_photo': slideshow[0]['time'] - last_written if slideshow else None,
+        'slideshow_mb': round(slideshow[0]['size'] / 1024 / 1024, 2) if slideshow else None,
+        'handler_wall': finished - started,
+        'telegram_requests': telegram['requests'],
+        'flood_errors': telegram['flood_errors'],
+        'rss_mb': round(own),
+        'child_rss_mb': round(children),
+    }
+
+    print(f"Режим {args.mode}: {len(received)}/{args.photos} фото по {result['photo_mb']} МБ, "
+          f"камера {args.rate} фото/с")
+    print(f"Задержка камера -> сервер, с: p50 {result['latency_p50']:.2f}  p90 {result['latency_p90']:.2f}  "
+          f"p99 {result['latency_p99']:.2f}  max {result['latency_max']:.2f}")
+    print(f"Сессия до последнего фото: {result['session_wall']:.1f} с, "
+          f"отставание после последнего снимка: {result['drain']:.1f} с")
+    if slideshow:
+        print(f"Слайдшоу ({result['slideshow_mb']} МБ) через {result['slideshow_after_last_photo']:.1f} с "
+              f"после последнего снимка (включая ожидание {args.idle} с без новых фото)")
+    else:
+        print("Слайдшоу не получено")
+    print(f"Запросов к Bot API: {dict(telegram['requests'])}, ответов 429: {telegram['flood_errors']}")
+    print(f"Пиковая память: бот {own:.0f} МБ, дочерние процессы {children:.0f} МБ")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--photos', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=2.0, help='фото в секунду')
+    parser.add_argument('--size', default='6000x4000')
+    parser.add_argument('--write-time', type=float, default=0.2, help='время записи одного файла камерой, с')
+    parser.add_argument('--mode', choices=['chat', 'group', 'cloud'], default='chat')
+    parser.add_argument('--idle', type=int, default=5, help='таймаут сессии без новых фото, с')
+    parser.add_argument('--telegram-delay', type=float, default=0.0)
+    parser.add_argument('--flood-limit', type=int, default=0)
+    parser.add_argument('--yandex-delay', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='МБ/с на одну загрузку')
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--yandex-port', type=int, default=8082)
+    parser.add_argument('--json', help='файл для сохранения результата')
+    args = parser.parse_args()
+
+    telegram_url = f'http://127.0.0.1:{args.telegram_port}'
+    yandex_url = f'http://127.0.0.1:{args.yandex_port}'
+    servers = start_fake_servers(telegram_port=args.telegram_port, yandex_port=args.yandex_port,
+                                 telegram_delay=args.telegram_delay, flood_limit=args.flood_limit,
+                                 yandex_delay=args.yandex_delay, bandwidth=args.bandwidth)
+    json_path = os.path.abspath(args.json) if args.json else None
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            camera_folder = os.path.join(work_dir, 'camera')
+            os.makedirs(camera_folder)
+            # Настройки читаются при импорте main.py; база и app.log создаются в рабочей папке
+            os.environ.update({
+                'BOT_TOKEN': TOKEN,
+                'TELEGRAM_API_URL': telegram_url,
+                'STORAGE_BACKEND': 'yandex',
+                'YANDEX': 'bench',
+                'YANDEX_API_URL': f'{yandex_url}/v1/disk',
+                'CAMERA_FOLDERS': camera_folder,
+                'DELIVERY_MODE': 'group' if args.mode == 'group' else 'single',
+            })
+            os.chdir(work_dir)
+            from logs import setup_logging, stop_logging
+            setup_logging()
+
+            camera, photo, started, finished, telegram, yandex = asyncio.run(
+                run_session(args, work_dir, camera_folder, telegram_url, yandex_url))
+            from database import close_db
+            close_db()
+            stop_logging()
+            os.chdir(cwd)
+            result = report(args, camera, photo, started, finished, telegram, yandex)
+            result['started'] = datetime.fromtimestamp(started).isoformat(timespec='seconds')
+    finally:
+        os.chdir(cwd)
+        servers.terminate()
+
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Сравнение способов сборки слайдшоу (ffmpeg concat demuxer и moviepy).
+
+Запуск из корня проекта:
+    python benchmarks/bench_slideshow.py --counts 50 200 500 --renderers ffmpeg moviepy
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import create_videos, FFMPEG_BINARY
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Синтетические фото 1920x1080: градиент с шумом, чтобы кодеку было что сжимать
+def make_photos(photo_dir, count, width=1920, height=1080):
+    gradient = np.linspace(0, 255, width).astype(np.uint16)[None, :, None]
+    for i in range(count):
+        noise = np.random.randint(0, 40, (height, width, 3), dtype=np.uint16)
+        frame = (gradient + noise + i * 7) % 256
+        if i % 3 == 0:
+            # Часть фото вертикальные, как при съемке с поворотом камеры
+            frame = frame[:, :height * height // width]
+        Image.fromarray(frame.astype(np.uint8)).save(os.path.join(photo_dir, f'{i:04d}.jpg'), quality=90)
+
+
+def make_audio(audio_dir, seconds=30):
+    subprocess.run([FFMPEG_BINARY, '-y', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+                    os.path.join(audio_dir, 'track.mp3')], check=True)
+
+
+def peak_memory_mb():
+    if resource is None:
+        return float('nan'), float('nan')
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+# Выполняется в отдельном процессе, чтобы пиковая память не смешивалась между прогонами
+def run_case(renderer, count, audio_dir, work_dir):
+    photo_dir = os.path.join(work_dir, f'{renderer}_{count}')
+    os.makedirs(photo_dir)
+    make_photos(photo_dir, count)
+
+    started = time.perf_counter()
+    video_path = create_videos(photo_dir, audio_dir, renderer=renderer)
+    elapsed = time.perf_counter() - started
+
+    size_mb = os.path.getsize(video_path) / (1024 * 1024) if video_path else float('nan')
+    own, children = peak_memory_mb()
+    shutil.rmtree(photo_dir)
+    return elapsed, size_mb, own, children
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--renderers', nargs='+', default=['ffmpeg', 'moviepy'], choices=['ffmpeg', 'moviepy'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        audio_dir = os.path.join(work_dir, 'music')
+        os.makedirs(audio_dir)
+        make_audio(audio_dir)
+
+        print(f"{'renderer':<10}{'photos':>8}{'time, s':>10}{'s/photo':>10}{'size, MB':>10}"
+              f"{'RSS, MB':>10}{'ffmpeg RSS':>12}")
+        for count in args.counts:
+            for renderer in args.renderers:
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    elapsed, size_mb, own, children = pool.submit(
+                        run_case, renderer, count, audio_dir, work_dir).result()
+                print(f"{renderer:<10}{count:>8}{elapsed:>10.1f}{elapsed / count:>10.3f}{size_mb:>10.1f}"
+                      f"{own:>10.0f}{children:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
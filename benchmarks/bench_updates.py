@@ -0,0 +1,167 @@
+"""Задержка доставки обновлений боту: long polling против webhook.
+
+Бот запускается целиком (main.main) с заглушкой Bot API из fake_servers.py. Заглушка
+получает команды /start от разных пользователей через POST /_updates и передает их боту
+так же, как Telegram: через getUpdates или, после setWebhook, запросом на webhook бота
+с заголовком секрета. Задержка - от постановки обновления до получения ответа бота (sendMessage).
+
+Запуск из корня проекта:
+    python benchmarks/bench_updates.py --mode polling --updates 200 --rate 50
+    python benchmarks/bench_updates.py --mode webhook --updates 200 --rate 50 --json webhook.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_servers import start_fake_servers
+from bench_session import TOKEN, percentile, fetch_stats
+
+FIRST_USER_ID = 2000
+
+
+def start_update(user_id):
+    return {
+        'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'chat': {'id': user_id, 'type': 'private'},
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+
+async def push_updates(session, telegram_url, count, rate):
+    pushed = {}
+    started = time.monotonic()
+    for i in range(count):
+        delay = started + i / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        user_id = FIRST_USER_ID + i
+        pushed[str(user_id)] = time.time()
+        async with session.post(f'{telegram_url}/_updates', json=start_update(user_id)) as resp:
+            resp.raise_for_status()
+    return pushed
+
+
+async def wait_answers(session, telegram_url, count, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        telegram = await fetch_stats(session, telegram_url)
+        if len(telegram['messages']) >= count or time.monotonic() > deadline:
+            return telegram
+        await asyncio.sleep(0.2)
+
+
+async def run_bot(args, telegram_url):
+    import aiohttp
+    import main
+
+    bot_task = asyncio.create_task(main.main())
+    async with aiohttp.ClientSession() as session:
+        # Бот готов, когда зарегистрировал webhook или начал опрос getUpdates
+        deadline = time.monotonic() + 10
+        while True:
+            requests = (await fetch_stats(session, telegram_url))['requests']
+            if requests.get('setWebhook') or requests.get('getUpdates'):
+                break
+            if bot_task.done() or time.monotonic() > deadline:
+                bot_task.result()
+                raise RuntimeError("Бот не начал получать обновления")
+            await asyncio.sleep(0.1)
+
+        pushed = await push_updates(session, telegram_url, args.updates, args.rate)
+        telegram = await wait_answers(session, telegram_url, args.updates, args.timeout)
+
+    bot_task.cancel()
+    try:
+        await bot_task
+    except asyncio.CancelledError:
+        pass
+    return pushed, telegram
+
+
+def report(args, pushed, telegram):
+    answered = {m['chat_id']: m['time'] for m in telegram['messages'] if m['chat_id'] in pushed}
+    latencies = [answered[chat_id] - pushed_at for chat_id, pushed_at in pushed.items() if chat_id in answered]
+    result = {
+        'mode': args.mode,
+        'updates': args.updates,
+        'answered': len(answered),
+        'rate': args.rate,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'latency_max': max(latencies, default=float('nan')),
+        'telegram_requests': telegram['requests'],
+        'webhook_errors': telegram['webhook_errors'],
+        'started': datetime.fromtimestamp(min(pushed.values())).isoformat(timespec='seconds'),
+    }
+    print(f"Режим {args.mode}: ответов {len(answered)}/{args.updates}, {args.rate} обновлений/с")
+    print(f"Задержка обновление -> ответ, мс: p50 {result['latency_p50'] * 1000:.1f}  "
+          f"p90 {result['latency_p90'] * 1000:.1f}  p99 {result['latency_p99'] * 1000:.1f}  "
+          f"max {result['latency_max'] * 1000:.1f}")
+    print(f"Запросов к Bot API: {dict(telegram['requests'])}, ошибок webhook: {telegram['webhook_errors']}")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='webhook')
+    parser.add_argument('--updates', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=50.0, help='обновлений в секунду')
+    parser.add_argument('--telegram-delay', type=float, default=0.0)
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8090)
+    parser.add_argument('--timeout', type=float, default=30, help='ожидание ответов после последнего обновления, с')
+    parser.add_argument('--json', help='файл для сохранения результата')
+    args = parser.parse_args()
+
+    telegram_url = f'http://127.0.0.1:{args.telegram_port}'
+    # Заглушка Яндекс.Диска не используется, но запускается вместе с Bot API
+    servers = start_fake_servers(telegram_port=args.telegram_port, yandex_port=args.telegram_port + 1,
+                                 telegram_delay=args.telegram_delay)
+    json_path = os.path.abspath(args.json) if args.json else None
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            # Настройки читаются при импорте main.py; база и app.log создаются в рабочей папке
+            os.environ.update({
+                'BOT_TOKEN': TOKEN,
+                'TELEGRAM_API_URL': telegram_url,
+                'BOT_MODE': args.mode,
+                'WEBHOOK_PORT': str(args.webhook_port),
+                'WEBHOOK_URL': f'http://127.0.0.1:{args.webhook_port}',
+                'WEBHOOK_SECRET': 'bench-secret',
+                'METRICS_PORT': '0',
+            })
+            os.chdir(work_dir)
+            from logs import setup_logging, stop_logging
+            setup_logging()
+            try:
+                pushed, telegram = asyncio.run(run_bot(args, telegram_url))
+            finally:
+                stop_logging()
+                os.chdir(cwd)
+            result = report(args, pushed, telegram)
+    finally:
+        os.chdir(cwd)
+        servers.terminate()
+
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
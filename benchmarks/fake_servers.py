@@ -0,0 +1,285 @@
+"""Локальные заглушки Telegram Bot API и REST API Яндекс.Диска для замеров без сети.
+
+Каждый принятый документ и загруженный файл записывается с временем получения,
+статистика доступна по GET /_stats. Обновления для бота ставятся через POST /_updates:
+их получает getUpdates или, после setWebhook, они отправляются на webhook бота. Запуск отдельно:
+    python benchmarks/fake_servers.py --telegram-port 8081 --yandex-port 8082
+и далее TELEGRAM_API_URL=http://127.0.0.1:8081 YANDEX_API_URL=http://127.0.0.1:8082/v1/disk
+"""
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import multiprocessing
+from collections import defaultdict, deque
+from urllib.parse import quote
+
+import aiohttp
+from aiohttp import web
+
+
+def ok(result):
+    return web.json_response({'ok': True, 'result': result})
+
+
+class FakeTelegram:
+    """Заглушка Bot API: методы отправки возвращают сообщения, файлы читаются и отбрасываются.
+    delay - задержка ответа (сек), flood_limit - сообщений в секунду на чат, сверх которых
+    отвечает 429 с retry_after, как настоящий Bot API"""
+    def __init__(self, delay=0.0, flood_limit=0):
+        self.delay = delay
+        self.flood_limit = flood_limit
+        self.deliveries = []
+        self.messages = []
+        self.requests = defaultdict(int)
+        self.flood_errors = 0
+        self.sent = defaultdict(deque)
+        self.message_id = 0
+        # Обновления для getUpdates (long polling бота)
+        self.updates = asyncio.Queue()
+        self.update_id = 0
+        # Адрес и секрет из setWebhook; пока webhook задан, getUpdates отвечает 409, как Bot API
+        self.webhook = None
+        self.webhook_errors = 0
+        self.http = None
+        self.webhook_tasks = set()
+
+    def app(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/bot{token}/{method}', self.handle)
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_post('/_updates', self.push_update)
+        return app
+
+    def message(self, chat_id, **fields):
+        self.message_id += 1
+        return {'message_id': self.message_id, 'date': int(time.time()),
+                'chat': {'id': int(chat_id or 0), 'type': 'private'}, **fields}
+
+    # Ограничение частоты сообщений в чат по скользящему окну в 1 секунду
+    def flooded(self, chat_id):
+        if not self.flood_limit or chat_id is None:
+            return 0
+        now = time.monotonic()
+        sent = self.sent[chat_id]
+        while sent and now - sent[0] >= 1:
+            sent.popleft()
+        if len(sent) >= self.flood_limit:
+            return 1
+        sent.append(now)
+        return 0
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.requests[method] += 1
+        form = await request.post() if request.method == 'POST' else request.query
+        # Время получения - после того, как файл полностью принят
+        received = time.time()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+
+        chat_id = form.get('chat_id')
+        if method in ('sendDocument', 'sendMediaGroup', 'sendMessage', 'sendPhoto'):
+            retry_after = self.flooded(chat_id)
+            if retry_after:
+                self.flood_errors += 1
+                return web.json_response({'ok': False, 'error_code': 429,
+                                          'description': f'Too Many Requests: retry after {retry_after}',
+                                          'parameters': {'retry_after': retry_after}}, status=429)
+
+        files = {name: value for name, value in form.items() if isinstance(value, web.FileField)}
+        for file in files.values():
+            size = len(file.file.read())
+            self.deliveries.append({'method': method, 'name': file.filename, 'size': size,
+                                    'time': received, 'chat_id': chat_id})
+
+        if method == 'sendMessage':
+            self.messages.append({'chat_id': chat_id, 'text': form.get('text', ''), 'time': received})
+
+        if method == 'getMe':
+            return ok({'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'})
+        if method == 'setWebhook':
+            self.webhook = (form['url'], form.get('secret_token'))
+            return ok(True)
+        if method == 'deleteWebhook':
+            self.webhook = None
+            return ok(True)
+        if method == 'getUpdates':
+            if self.webhook:
+                return web.json_response({'ok': False, 'error_code': 409,
+                                          'description': "Conflict: can't use getUpdates method "
+                                                         "while webhook is active"}, status=409)
+            return ok(await self.get_updates(float(form.get('timeout') or 0)))
+        if method == 'sendDocument':
+            file = next(iter(files.values()), None)
+            name = file.filename if file else 'document'
+            return ok(self.message(chat_id, document={'file_id': uuid.uuid4().hex,
+                                                      'file_unique_id': uuid.uuid4().hex[:16],
+                                                      'file_name': name}))
+        if method == 'sendMediaGroup':
+            media = json.loads(form.get('media', '[]'))
+            return ok([self.message(chat_id, document={'file_id': uuid.uuid4().hex,
+                                                       'file_unique_id': uuid.uuid4().hex[:16]})
+                       for _ in media])
+        if method in ('sendMessage', 'editMessageText'):
+            return ok(self.message(chat_id, text=form.get('text', '')))
+        return ok(True)
+
+    async def get_updates(self, timeout):
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout=timeout))
+        except asyncio.TimeoutError:
+            return updates
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    # Постановка обновления в очередь getUpdates или отправка на webhook (update_id назначается здесь)
+    async def push_update(self, request):
+        update = await request.json()
+        self.update_id += 1
+        update['update_id'] = self.update_id
+        if self.webhook:
+            # Как Bot API: обновления отправляются параллельно, не дожидаясь ответа на предыдущие
+            task = asyncio.create_task(self.send_webhook(update))
+            self.webhook_tasks.add(task)
+            task.add_done_callback(self.webhook_tasks.discard)
+        else:
+            await self.updates.put(update)
+        return web.json_response({'update_id': self.update_id})
+
+    async def send_webhook(self, update):
+        url, secret = self.webhook
+        if self.http is None:
+            self.http = aiohttp.ClientSession()
+        headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+        try:
+            async with self.http.post(url, json=update, headers=headers) as resp:
+                if resp.status != 200:
+                    self.webhook_errors += 1
+        except aiohttp.ClientError:
+            self.webhook_errors += 1
+
+    async def stats(self, request):
+        return web.json_response({'deliveries': self.deliveries, 'messages': self.messages,
+                                  'requests': self.requests, 'flood_errors': self.flood_errors,
+                                  'webhook_errors': self.webhook_errors})
+
+
+class FakeYandexDisk:
+    """Заглушка REST API Яндекс.Диска. bandwidth - скорость приема одного файла (МБ/с, 0 - без ограничения)"""
+    def __init__(self, base_url, delay=0.0, bandwidth=0.0):
+        self.base_url = base_url.rstrip('/')
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.folders = set()
+        self.uploads = []
+
+    def app(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_put('/v1/disk/resources', self.create_folder)
+        app.router.add_get('/v1/disk/resources', self.resource)
+        app.router.add_put('/v1/disk/resources/publish', self.publish)
+        app.router.add_get('/v1/disk/resources/upload', self.upload_url)
+        app.router.add_put('/upload', self.upload)
+        app.router.add_get('/_stats', self.stats)
+        return app
+
+    async def create_folder(self, request):
+        path = request.query['path']
+        if path in self.folders:
+            return web.json_response({'error': 'DiskPathPointsToExistentDirectoryError'}, status=409)
+        self.folders.add(path)
+        return web.json_response({'href': f"{self.base_url}/v1/disk/resources?path={quote(path)}"}, status=201)
+
+    async def publish(self, request):
+        return web.json_response({'href': f"{self.base_url}/v1/disk/resources?path={quote(request.query['path'])}"})
+
+    async def resource(self, request):
+        path = request.query['path']
+        return web.json_response({'path': path, 'type': 'dir',
+                                  'public_url': f"{self.base_url}/public/{quote(path)}"})
+
+    async def upload_url(self, request):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.json_response({'href': f"{self.base_url}/upload?path={quote(request.query['path'])}",
+                                  'method': 'PUT', 'templated': False})
+
+    async def upload(self, request):
+        started = time.monotonic()
+        size = 0
+        async for chunk in request.content.iter_chunked(256 * 1024):
+            size += len(chunk)
+            if self.bandwidth:
+                lag = size / (self.bandwidth * 1024 * 1024) - (time.monotonic() - started)
+                if lag > 0:
+                    await asyncio.sleep(lag)
+        self.uploads.append({'name': request.query['path'].rsplit('/', 1)[-1], 'size': size,
+                             'time': time.time()})
+        return web.Response(status=201)
+
+    async def stats(self, request):
+        return web.json_response({'deliveries': self.uploads, 'folders': sorted(self.folders)})
+
+
+async def serve(host, telegram_port, yandex_port, options, ready=None):
+    telegram = FakeTelegram(options.get('telegram_delay', 0), options.get('flood_limit', 0))
+    yandex = FakeYandexDisk(f"http://{host}:{yandex_port}", options.get('yandex_delay', 0),
+                            options.get('bandwidth', 0))
+    runners = []
+    for app, port in ((telegram.app(), telegram_port), (yandex.app(), yandex_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        runners.append(runner)
+    if ready is not None:
+        ready.set()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def _run(host, telegram_port, yandex_port, options, ready):
+    try:
+        asyncio.run(serve(host, telegram_port, yandex_port, options, ready))
+    except KeyboardInterrupt:
+        pass
+
+
+# Запуск заглушек в отдельном процессе, чтобы они не делили event loop и GIL с ботом
+def start_fake_servers(host='127.0.0.1', telegram_port=8081, yandex_port=8082, **options):
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=_run, args=(host, telegram_port, yandex_port, options, ready),
+                                      daemon=True)
+    process.start()
+    if not ready.wait(10):
+        process.terminate()
+        raise RuntimeError("Заглушки серверов не запустились")
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--yandex-port', type=int, default=8082)
+    parser.add_argument('--telegram-delay', type=float, default=0.0)
+    parser.add_argument('--flood-limit', type=int, default=0)
+    parser.add_argument('--yandex-delay', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=float, default=0.0)
+    args = parser.parse_args()
+    options = {'telegram_delay': args.telegram_delay, 'flood_limit': args.flood_limit,
+               'yandex_delay': args.yandex_delay, 'bandwidth': args.bandwidth}
+    print(f"Telegram: http://{args.host}:{args.telegram_port}, "
+          f"Яндекс.Диск: http://{args.host}:{args.yandex_port}/v1/disk")
+    _run(args.host, args.telegram_port, args.yandex_port, options, None)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,104 @@
+import os
+import time
+import asyncio
 import sqlite3
+import threading
+import logging
+import functools
+from collections import OrderedDict
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import timer
+
+
+DB_NAME = 'database.db'
+# Максимальный размер пачки file_id до принудительной записи
+FILE_ID_BATCH_SIZE = 50
+# Срок хранения и максимальное количество записей file_id_map
+FILE_ID_MAX_AGE_DAYS = int(os.getenv('FILE_ID_MAX_AGE_DAYS', 90))
+FILE_ID_MAX_ROWS = int(os.getenv('FILE_ID_MAX_ROWS', 100000))
+# Размер кеша недавно отправленных file_id
+FILE_ID_CACHE_SIZE = 1024
+# Количество повторных попыток доставки фото и базовая задержка между ними (сек)
+JOB_MAX_RETRIES = int(os.getenv('JOB_MAX_RETRIES', 5))
+JOB_RETRY_DELAY = int(os.getenv('JOB_RETRY_DELAY', 30))
+# Страниц, освобождаемых за один шаг сжатия базы
+VACUUM_STEP_PAGES = 256
+
+# Постоянное подключение к базе данных (скомпилированные запросы кешируются в нем)
+_conn = None
+_lock = threading.RLock()
+# Отдельный поток для запросов из асинхронного кода
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+# Отложенная запись file_id: хеш -> file_id
+_pending_file_ids = {}
+# Защищает _pending_file_ids и _file_id_cache; add_file_id вызывается из event loop
+# и не должен ждать _lock, пока в потоке базы выполняется запрос
+_file_ids_lock = threading.Lock()
+
+
+class LRUCache:
+    """Небольшой кеш с вытеснением давно не использованных записей"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+
+    def get(self, key):
+        if key not in self.data:
+            return None
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
+_file_id_cache = LRUCache(FILE_ID_CACHE_SIZE)
+
+
+def get_connection():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(DB_NAME, check_same_thread=False, cached_statements=128)
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute('PRAGMA synchronous=NORMAL')
+    return _conn
 
 
 # Контекстный менеджер для управления подключением к базе данных
 @contextmanager
-def connect_db(db_name='database.db'):
-    conn = sqlite3.connect(db_name)
-    try:
-        yield conn
-    finally:
-        conn.close()
+def connect_db():
+    with _lock:
+        yield get_connection()
+
+
+def close_db():
+    global _conn
+    flush_file_ids()
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+# Выполнение функции базы данных в отдельном потоке, не блокируя цикл событий
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    with timer(f'db_{func.__name__}'):
+        return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
 
 
 # Инициализация базы данных: создание таблиц
 def init_db():
     with connect_db() as conn:
+        # Сжатие по шагам (incremental_vacuum) вместо VACUUM; существующая база переводится однократно
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
         cursor = conn.cursor()
         cursor.execute('''CREATE TABLE IF NOT EXISTS users_folders (
             user_id INTEGER PRIMARY KEY,
@@ -23,8 +107,40 @@ def init_db():
         )''')
         cursor.execute('''CREATE TABLE IF NOT EXISTS file_id_map (
             file_id_hash TEXT PRIMARY KEY,
-            file_id TEXT
+            file_id TEXT,
+            created_at REAL
+        )''')
+        # Миграция базы, созданной до появления created_at
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(file_id_map)')]
+        if 'created_at' not in columns:
+            cursor.execute('ALTER TABLE file_id_map ADD COLUMN created_at REAL')
+            cursor.execute('UPDATE file_id_map SET created_at = ?', (time.time(),))
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_file_id_map_created_at ON file_id_map (created_at)')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS client_phones (
+            phone_number TEXT PRIMARY KEY,
+            client_id INTEGER,
+            updated_at REAL
+        )''')
+        cursor.execute('''CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )''')
+        # Задания доставки фото: одно на каждое назначение (chat, disk, slideshow).
+        # Задание video (file_path - папка слайдшоу) - отправка слайдшоу всей сессии,
+        # задание link (file_path - папка в хранилище) - ссылка, если хранилище было недоступно
+        cursor.execute('''CREATE TABLE IF NOT EXISTS photo_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path TEXT,
+            destination TEXT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            phone_number TEXT,
+            state TEXT,
+            retries INTEGER DEFAULT 0,
+            updated_at REAL,
+            UNIQUE (file_path, destination)
         )''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_photo_jobs_state ON photo_jobs (state, updated_at)')
         conn.commit()
 
 
@@ -45,19 +161,238 @@ def get_user_folder(user_id):
         return cursor.fetchone()
 
 
-# Функция для добавления file_id
+# Функция для добавления file_id: запись откладывается и выполняется пачкой
 def add_file_id(file_id_hash, file_id):
-    with connect_db() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''REPLACE INTO file_id_map (file_id_hash, file_id) VALUES (?, ?)''', (file_id_hash, file_id))
-        conn.commit()
+    with _file_ids_lock:
+        _pending_file_ids[file_id_hash] = file_id
+        _file_id_cache.put(file_id_hash, file_id)
+        batch_full = len(_pending_file_ids) >= FILE_ID_BATCH_SIZE
+    if batch_full:
+        _db_executor.submit(flush_file_ids)
+
+
+# Запись накопленных file_id одной транзакцией
+def flush_file_ids():
+    with _file_ids_lock:
+        if not _pending_file_ids:
+            return
+        batch = list(_pending_file_ids.items())
+        _pending_file_ids.clear()
+    now = time.time()
+    try:
+        with connect_db() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''REPLACE INTO file_id_map (file_id_hash, file_id, created_at) VALUES (?, ?, ?)''',
+                               [(file_id_hash, file_id, now) for file_id_hash, file_id in batch])
+            conn.commit()
+        logging.debug(f"[flush_file_ids] Записано file_id: {len(batch)}")
+    except sqlite3.Error:
+        # Возвращаем пачку в очередь до следующей попытки
+        with _file_ids_lock:
+            for file_id_hash, file_id in batch:
+                _pending_file_ids.setdefault(file_id_hash, file_id)
+        raise
+
+
+# Фоновая запись отложенных file_id
+async def file_ids_flush_loop(interval=1):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_db(flush_file_ids)
+        except Exception as e:
+            logging.error(f"[file_ids_flush_loop] Ошибка записи file_id: {e}")
 
 
 # Функция для получения file_id по хешу
 def get_file_id(file_id_hash):
+    with _file_ids_lock:
+        file_id = _pending_file_ids.get(file_id_hash) or _file_id_cache.get(file_id_hash)
+        if file_id:
+            return file_id
     with connect_db() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT file_id FROM file_id_map WHERE file_id_hash = ?', (file_id_hash,))
         result = cursor.fetchone()
+    if not result:
+        return None
+    with _file_ids_lock:
+        _file_id_cache.put(file_id_hash, result[0])
+    return result[0]
+
+
+# Удаление старых file_id: старше max_age_days и сверх max_rows самых новых
+def evict_file_ids(max_age_days=FILE_ID_MAX_AGE_DAYS, max_rows=FILE_ID_MAX_ROWS):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM file_id_map WHERE created_at < ?', (time.time() - max_age_days * 86400,))
+        deleted = cursor.rowcount
+        cursor.execute('''DELETE FROM file_id_map WHERE file_id_hash IN (
+            SELECT file_id_hash FROM file_id_map ORDER BY created_at DESC LIMIT -1 OFFSET ?
+        )''', (max_rows,))
+        deleted += cursor.rowcount
+        conn.commit()
+        return deleted
+
+
+# Функция для создания заданий доставки фото, возвращает {назначение: id задания}
+def add_jobs(file_path, user_id, chat_id, phone_number, destinations):
+    now = time.time()
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''INSERT INTO photo_jobs (file_path, destination, user_id, chat_id, phone_number, state, retries, updated_at)
+                              VALUES (?, ?, ?, ?, ?, 'pending', 0, ?)
+                              ON CONFLICT (file_path, destination) DO UPDATE SET
+                              user_id = excluded.user_id, chat_id = excluded.chat_id, phone_number = excluded.phone_number,
+                              state = 'pending', retries = 0, updated_at = excluded.updated_at''',
+                           [(file_path, destination, user_id, chat_id, phone_number, now) for destination in destinations])
+        conn.commit()
+        cursor.execute(f'''SELECT destination, id FROM photo_jobs
+                           WHERE file_path = ? AND destination IN ({','.join('?' * len(destinations))})''',
+                       (file_path, *destinations))
+        return dict(cursor.fetchall())
+
+
+def set_job_state(job_id, state):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE photo_jobs SET state = ?, updated_at = ? WHERE id = ?', (state, time.time(), job_id))
+        conn.commit()
+
+
+# Неудачная попытка: задание ждет повтора или окончательно помечается failed
+def fail_job(job_id, max_retries=JOB_MAX_RETRIES):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''UPDATE photo_jobs SET retries = retries + 1,
+                          state = CASE WHEN retries + 1 >= ? THEN 'failed' ELSE 'retry' END,
+                          updated_at = ? WHERE id = ?''', (max_retries, time.time(), job_id))
+        conn.commit()
+
+
+# Задания, ожидающие повтора, с экспоненциально растущей задержкой
+def get_retry_jobs(retry_delay=JOB_RETRY_DELAY):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''SELECT id, file_path, destination, user_id, chat_id, phone_number FROM photo_jobs
+                          WHERE state = 'retry' AND updated_at + ? * (1 << retries) <= ?
+                          ORDER BY id''', (retry_delay, time.time()))
+        return cursor.fetchall()
+
+
+# После перезапуска незавершенные задания передаются фоновому повтору
+def reset_pending_jobs():
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE photo_jobs SET state = 'retry', updated_at = 0 WHERE state = 'pending'")
+        conn.commit()
+        return cursor.rowcount
+
+
+# Количество незавершенных заданий по файлу: файл удаляется только когда их нет
+def count_open_jobs(file_path):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM photo_jobs WHERE file_path = ? AND state != 'done'", (file_path,))
+        return cursor.fetchone()[0]
+
+
+def get_job_state(file_path, destination):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT state FROM photo_jobs WHERE file_path = ? AND destination = ?', (file_path, destination))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+
+# Удаление выполненных заданий старше max_age_days
+def purge_done_jobs(max_age_days=7):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM photo_jobs WHERE state = 'done' AND updated_at < ?",
+                       (time.time() - max_age_days * 86400,))
+        conn.commit()
+        return cursor.rowcount
+
+
+# Обслуживание базы: удаление старых file_id и заданий
+def maintain_db():
+    deleted = evict_file_ids() + purge_done_jobs()
+    logging.info(f"[maintain_db] Удалено записей: {deleted}")
+    return deleted
+
+
+# Один шаг сжатия файла базы, возвращает число оставшихся свободных страниц
+def vacuum_step(pages=VACUUM_STEP_PAGES):
+    with connect_db() as conn:
+        conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free_pages:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return free_pages
+
+
+# Периодическое обслуживание базы. Сжатие идет короткими шагами,
+# между которыми поток базы выполняет остальные запросы
+async def db_maintenance_loop(interval=24 * 3600):
+    while True:
+        try:
+            if await run_db(maintain_db):
+                while await run_db(vacuum_step):
+                    pass
+        except Exception as e:
+            logging.error(f"[db_maintenance_loop] Ошибка обслуживания базы: {e}")
+        await asyncio.sleep(interval)
+
+
+# Функция для сохранения номеров клиентов YCLIENTS (список пар (номер, id клиента))
+def add_client_phones(clients):
+    now = time.time()
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''REPLACE INTO client_phones (phone_number, client_id, updated_at) VALUES (?, ?, ?)''',
+                           [(phone, client_id, now) for phone, client_id in clients])
+        conn.commit()
+
+
+# Функция для полной замены справочника номеров: удаляет номера, не попавшие в выгрузку
+def replace_client_phones(clients):
+    sync_started = time.time()
+    add_client_phones(clients)
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM client_phones WHERE updated_at < ?', (sync_started,))
+        conn.commit()
+
+
+# Функция для проверки номера в локальном справочнике
+def is_client_phone(phone_number):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1 FROM client_phones WHERE phone_number = ?', (phone_number,))
+        return cursor.fetchone() is not None
+
+
+# Функция для получения максимального id клиента (граница инкрементальной синхронизации)
+def get_max_client_id():
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT MAX(client_id) FROM client_phones')
+        result = cursor.fetchone()
+        return result[0] if result and result[0] is not None else 0
+
+
+# Функции для хранения служебных значений синхронизации
+def get_sync_value(key):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT value FROM sync_state WHERE key = ?', (key,))
+        result = cursor.fetchone()
         return result[0] if result else None
-    
\ No newline at end of file
+
+
+def set_sync_value(key, value):
+    with connect_db() as conn:
+        cursor = conn.cursor()
+        cursor.execute('REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, str(value)))
+        conn.commit()
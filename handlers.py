@@ -3,7 +3,7 @@ from aiogram.types import Message
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from yclients_conn import get_client_phone_numbers
+from yclients_conn import check_client_phone
 from utils import normalize_phone_number 
                    
 
@@ -45,9 +45,7 @@ async def handle_phone_number(message: types.Message):
         await message.answer("Неверный формат номера. Попробуйте еще раз.")
         return
     
-    clients = await get_client_phone_numbers()
-
-    if phone_number in clients:
+    if await check_client_phone(phone_number):
         keyboard = InlineKeyboardBuilder()
         keyboard.button(text="Начать фотосессию", callback_data=f'start_session_{phone_number}')
         keyboard.adjust(1)
@@ -0,0 +1,165 @@
+import os
+import copy
+import json
+import time
+import queue
+import logging
+import threading
+import contextvars
+import multiprocessing
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# json - одна запись JSON на строку, text - прежний текстовый формат
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Ротация: размер файла (МБ) и количество старых файлов
+LOG_MAX_MB = float(os.getenv('LOG_MAX_MB', 10))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+# Одинаковые отладочные записи (из циклов опроса) пишутся не чаще раза в LOG_DEBUG_INTERVAL секунд
+LOG_DEBUG_INTERVAL = float(os.getenv('LOG_DEBUG_INTERVAL', 10))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Поля записи, которые попадают в JSON, если заданы через extra или контекст
+CONTEXT_FIELDS = ('session', 'user_id', 'phone', 'stage', 'duration', 'suppressed')
+
+# Поля текущей сессии; наследуются задачами, созданными в обработчике
+_log_context = contextvars.ContextVar('log_context', default={})
+_listeners = []
+_worker_queue = None
+
+
+def bind_log_context(**fields):
+    """Добавляет поля (session, user_id, phone) ко всем записям текущей задачи и ее подзадач"""
+    _log_context.set({**_log_context.get(), **fields})
+
+
+class ContextFilter(logging.Filter):
+    """Переносит поля контекста в запись. Работает в потоке, который пишет запись"""
+    def filter(self, record):
+        for name, value in _log_context.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Отладочные записи из одного места кода (и одного этапа) - не чаще раза в interval секунд.
+    Число пропущенных записей попадает в поле suppressed следующей"""
+    def __init__(self, interval=LOG_DEBUG_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self.last = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.name, record.pathname, record.lineno, getattr(record, 'stage', None))
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last.get(key, -self.interval) < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            self.last[key] = now
+            suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class LogQueueHandler(QueueHandler):
+    """Как QueueHandler, но текст исключения передается отдельно от сообщения (поле exc в JSON)"""
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'message': record.getMessage(),
+        }
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = round(value, 4) if name == 'duration' else value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def _file_handler():
+    handler = RotatingFileHandler(LOG_FILE, maxBytes=int(LOG_MAX_MB * 1024 * 1024),
+                                  backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def setup_logging():
+    """Записи кладутся в очередь в вызывающем потоке, в файл их пишет поток QueueListener,
+    поэтому запись в лог не блокирует event loop"""
+    if _listeners:
+        return
+    handler = _file_handler()
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+
+
+# Очередь для записей из процессов пула; их пишет в тот же файл отдельный QueueListener
+def get_worker_log_queue():
+    global _worker_queue
+    if _worker_queue is None and _listeners:
+        _worker_queue = multiprocessing.Queue()
+        listener = QueueListener(_worker_queue, *_listeners[0].handlers, respect_handler_level=True)
+        listener.start()
+        _listeners.append(listener)
+    return _worker_queue
+
+
+# Настройка логирования в процессе пула: записи передаются в основной процесс
+def setup_worker_logging(log_queue):
+    if log_queue is None:
+        return
+    root = logging.getLogger()
+    root.handlers = [LogQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+
+def stop_logging():
+    global _worker_queue
+    while _listeners:
+        listener = _listeners.pop()
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+    _worker_queue = None
@@ -2,27 +2,67 @@ import os
 import logging
 import asyncio
 import aiohttp
-import hashlib
-from aiogram.types import BufferedInputFile
-from watchdog.observers import Observer
+import functools
+import uuid
+import multiprocessing
+from collections import defaultdict
+from aiogram.types import BufferedInputFile, InputMediaDocument
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import FSInputFile
-from datetime import datetime, timedelta
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from handlers import router
-from database import init_db, add_or_update_user, get_user_folder, add_file_id, get_file_id
+from sessions import SessionManager, iter_session_files, batch_files
+from yclients_conn import client_phones_sync_loop, close_http_client
+from database import (init_db,
+                      add_or_update_user,
+                      get_user_folder,
+                      add_file_id,
+                      get_file_id,
+                      run_db,
+                      file_ids_flush_loop,
+                      db_maintenance_loop,
+                      close_db,
+                      add_jobs,
+                      set_job_state,
+                      fail_job,
+                      get_retry_jobs,
+                      reset_pending_jobs,
+                      count_open_jobs,
+                      get_job_state
+                    )
 from utils import (API_TOKEN,
-                   PhotoHandler,                    
-                   upload_file, 
-                   convert_photo,
-                   create_and_publish_folder,
-                   retry_on_failure,
-                   resize_photo,
-                   create_videos                                     
+                   UploadPipeline,
+                   RateLimiter,
+                   FileCache,
+                   retry_on_failure
                 )
-
-
-bot = Bot(token=API_TOKEN)
+from storage import get_storage
+from profiling import setup_profiling, start_loop_monitor, stop_loop_monitor
+from logs import setup_logging, stop_logging, bind_log_context
+from webhook import BOT_MODE, run_webhook
+from metrics import (timer,
+                     timed,
+                     SessionStats,
+                     set_session_stats,
+                     start_metrics_server,
+                     stop_metrics_server,
+                     SESSIONS
+                    )
+from slideshow import SlideshowWriter
+from workers import (resize_photo_async,
+                     convert_photo_async,
+                     create_videos_async,
+                     run_in_thread,
+                     shutdown as shutdown_workers
+                    )
+
+
+# Адрес Bot API: локальный telegram-bot-api сервер или тестовый сервер из benchmarks
+telegram_api_url = os.getenv('TELEGRAM_API_URL')
+bot = Bot(token=API_TOKEN,
+          session=AiohttpSession(api=TelegramAPIServer.from_base(telegram_api_url)) if telegram_api_url else None)
 dp = Dispatcher()
 
 # Инициализация базы данных
@@ -31,38 +71,56 @@ init_db()
 
 # Задаем глобальные переменные
 timeout = 600 # таймаут для завершения сессии
-user_in_session = None
 audio_folder = r'C:\music'
 slideshow_folder = r'C:\slideshow'
-general_folder = r'C:\photo'
 clients_folder = r'C:\clients'
+cache_folder = r'C:\cache'
+
+# Оригиналы недавно отправленных фото для кнопки Ч/Б
+originals_cache = FileCache(cache_folder, max_files=200)
+
+# Активные фотосессии по пользователям и камерам
+sessions = SessionManager()
+# Номера, для которых сейчас идет доставка фото
+active_deliveries = set()
+
+# Режим доставки в чат: single - по одному документу с кнопкой Ч/Б,
+# group - альбомами до 10 документов (без кнопки Ч/Б, меньше запросов к API)
+delivery_mode = os.getenv('DELIVERY_MODE', 'single')
+media_group_size = 10
+media_group_wait = 3 # сколько секунд ждать заполнения альбома
+
+# Ограничения Telegram: около 30 сообщений в секунду всего и около 1 в секунду в один чат
+global_limiter = RateLimiter(rate=30, capacity=30)
+chat_limiters = defaultdict(lambda: RateLimiter(rate=1, capacity=3))
 
 
 
 # Обработчик нажатия кнопок
 @dp.callback_query(F.data.startswith('start_session_'))
 async def callback_start_session(query: types.CallbackQuery):
-    global user_in_session
     user_id = query.from_user.id
     phone_number = query.data.split('_')[2]
-    folder = os.path.join(clients_folder, phone_number)    
-
-    if user_in_session is None:
-        user_in_session = user_id
-        add_or_update_user(user_id, phone_number, folder)
-        os.makedirs(folder, exist_ok=True)        
-        asyncio.create_task(start_watchdog(phone_number, general_folder, clients_folder))       
-
-        keyboard = InlineKeyboardBuilder()
-        keyboard.button(text="Получить фото в чате", callback_data=f'get_photos_{phone_number}')
-        keyboard.button(text="Загрузить фото в облако", callback_data=f'upload_to_cloud_{phone_number}')
-        keyboard.adjust(1)        
-        await query.message.edit_text(
-            "Пожалуйста, фотографируйтесь",
-            reply_markup=keyboard.as_markup()
-        )                
-    else:
+
+    session = sessions.start_session(user_id, phone_number, clients_folder, slideshow_folder, timeout)
+    if session is None:
         await query.message.edit_text("Бот занят, попробуйте позже.")
+        return
+
+    await run_db(add_or_update_user, user_id, phone_number, session.folder)
+
+    keyboard = InlineKeyboardBuilder()
+    keyboard.button(text="Получить фото в чате", callback_data=f'get_photos_{phone_number}')
+    keyboard.button(text="Загрузить фото в облако", callback_data=f'upload_to_cloud_{phone_number}')
+    keyboard.adjust(1)
+    booth = sessions.camera_folders.index(session.camera_folder) + 1
+    text = "Пожалуйста, фотографируйтесь"
+    if len(sessions.camera_folders) > 1:
+        text += f" (фотозона {booth})"
+    await query.message.edit_text(
+        text,
+        reply_markup=keyboard.as_markup()
+    )
 
 
 
@@ -72,8 +130,8 @@ async def callback_get_bw_photo(query: types.CallbackQuery):
     await query.answer()
 
     data = query.data.split('_')    
+    file_id_hash = data[2]
     message_id = query.message.message_id
-    file_id = get_file_id(data[2])
     origin_name = query.message.document.file_name.split('.')        
 
     # Обновляем сообщение, удаляя кнопку
@@ -82,42 +140,44 @@ async def callback_get_bw_photo(query: types.CallbackQuery):
                     message_id=message_id, 
                     reply_markup=None
                 )
-    
-     # Получаем файл по id
-    file = await retry_on_failure(bot.get_file, file_id)
-    file_path = file.file_path
-
-    # Загружаем файл
-    downloaded_file = await retry_on_failure(bot.download_file, file_path)
-
-    bw_image_path = convert_photo(downloaded_file, origin_name[0])
 
     try:
-        # Отправляем черно-белое изображение
-        with open(bw_image_path, 'rb') as f:
-            bw_file_data = f.read()
+        # Ч/Б версия уже отправлялась - пересылаем по file_id без конвертации и загрузки
+        bw_file_id = await run_db(get_file_id, f'bw_{file_id_hash}')
+        if bw_file_id:
+            await retry_on_failure(bot.send_document, chat_id=query.message.chat.id, document=bw_file_id)
+            return
+
+        # Оригинал из текущей сессии берется из локального кеша, иначе скачивается из Telegram
+        original = originals_cache.get(file_id_hash)
+        if original is None:
+            file_id = await run_db(get_file_id, file_id_hash)
+            file = await retry_on_failure(bot.get_file, file_id)
+            original = await retry_on_failure(bot.download_file, file.file_path)
 
-        bw_buffered = BufferedInputFile(bw_file_data, filename=os.path.basename(bw_image_path))
+        bw_data = await convert_photo_async(original)
 
-        await retry_on_failure(bot.send_document, chat_id=query.message.chat.id, document=bw_buffered)
+        # Отправляем черно-белое изображение
+        bw_file = BufferedInputFile(bw_data, filename=f"bw_{origin_name[0]}.jpg")
+        message = await retry_on_failure(bot.send_document, chat_id=query.message.chat.id, document=bw_file)
+        add_file_id(f'bw_{file_id_hash}', message.document.file_id)
     except Exception as send_photo_err:
         logging.error(f"[callback_get_bw_photo] Ошибка при отправке Ч/Б фото в чат: {send_photo_err}")
-    finally:
-        # Удаляем временный файл
-        if os.path.exists(bw_image_path):
-            os.remove(bw_image_path)
     
 
 
 # Обработчик отправки фотографий в чат
 @dp.callback_query(F.data.startswith('get_photos_'))
 async def callback_get_photos(query: types.CallbackQuery,
-                              check_interval: int = 10, 
                               max_wait_time: int = timeout):
-    global slideshow_folder, audio_folder
     user_id = query.from_user.id
-    user_data = get_user_folder(user_id)
+    chat_id = query.message.chat.id
+    user_data = await run_db(get_user_folder, user_id)
+    phone_number = user_data[0] if user_data else ''
     folder = user_data[1] if user_data else ''
+    session_slideshow_folder = os.path.join(slideshow_folder, phone_number)
+    slideshow = SlideshowWriter(os.path.join(session_slideshow_folder, 'slideshow.mp4'))
+    stage = SlideshowStage(slideshow, session_slideshow_folder)
 
     logging.info(f"User ID: {user_id}, Folder: {folder}")
     
@@ -128,96 +188,59 @@ async def callback_get_photos(query: types.CallbackQuery,
     # Обновление сообщения для удаления клавиатуры
     await query.message.edit_text("После загрузки всех фотографий вам придет сообщение")
 
-    elapsed_time = 0  # Время, прошедшее с последней проверки, когда были файлы
-
-    while elapsed_time <= max_wait_time:
-        try:
-            files = os.listdir(folder)
-            logging.info(f"Files found чат: {files}") 
-            if files:
-                for filename in files:
-                    file_path = os.path.join(folder, filename)
-                    if os.path.isfile(file_path):
-                        try: 
-                            with open(file_path, 'rb') as f:
-                                file_data = f.read()
-
-                            buffered_file = BufferedInputFile(file_data, filename=filename)
-
-                            # Отправка файла
-                            message = await retry_on_failure(bot.send_document, chat_id=query.message.chat.id, document=buffered_file)
-                        
-                            # Использование хеширования для создания callback_data
-                            file_id_hash = hashlib.md5(message.document.file_id.encode()).hexdigest()
-
-                            # Сохранение связи хеш -> file_id
-                            add_file_id(file_id_hash, message.document.file_id)
-
-                            keyboard = InlineKeyboardBuilder()
-                            keyboard.button(text="Получить Ч/Б фото", callback_data=f'get_bw_{file_id_hash}')                    
-                            keyboard.adjust(1)
-
-                            # Добавляем клавиатуру к сообщению
-                            await bot.edit_message_reply_markup(chat_id=query.message.chat.id, 
-                                                                message_id=message.message_id, 
-                                                                reply_markup=keyboard.as_markup()
-                                                            )
-                            
-                            # Добавляем фото в папку для слайдшоу
-                            resize_photo(file_path, slideshow_folder)
-                            os.remove(file_path)  
-                        except Exception as send_photo_err:
-                            logging.error(f"[upload_to_chat] Ошибка при отправке фото в чат: {send_photo_err}")
-                        # finally:
-                        #     if os.path.exists(file_path):
-
-                        await asyncio.sleep(1)
-                        elapsed_time = 0  # Сбрасываем счетчик времени                       
+    active_deliveries.add(phone_number)
+    photo_session = sessions.get(user_id)
+    stats = photo_session.stats if photo_session else SessionStats(phone_number)
+    set_session_stats(stats)
+    bind_log_context(session=photo_session.id if photo_session else None, user_id=user_id, phone=phone_number)
+    # Если сессия прервется до отправки слайдшоу, его соберет фоновый повтор
+    video_job = (await run_db(add_jobs, session_slideshow_folder, user_id, chat_id, phone_number, ('video',)))['video']
+    try:
+        # Каждое фото (или альбом) отправляется сразу после того, как PhotoHandler его принял
+        group_size = media_group_size if delivery_mode == 'group' else 1
+        files = iter_session_files(folder, photo_session, max_wait_time)
+        async for batch in batch_files(files, group_size, media_group_wait):
+            jobs = [await run_db(add_jobs, file_path, user_id, chat_id, phone_number, ('chat', 'slideshow'))
+                    for file_path in batch]
+            if len(batch) == 1:
+                await run_job(jobs[0]['chat'], send_photo_to_chat, chat_id, batch[0])
             else:
-                await asyncio.sleep(check_interval)
-                elapsed_time += check_interval
-                logging.info(f"Elapsed time чат: {elapsed_time}")
-                if elapsed_time >= max_wait_time:                    
-                    path_video_file = create_videos(slideshow_folder, audio_folder)
-                    if path_video_file:
-                        try:
-                            with open(path_video_file, 'rb') as f:
-                                video_data = f.read()
-
-                            video_buffered = BufferedInputFile(video_data, filename=os.path.basename(path_video_file))
-                            
-                            await retry_on_failure(
-                                bot.send_document,
-                                chat_id=query.message.chat.id,
-                                document=video_buffered
-                            )                 
-                            logging.info(f"[upload_to_chat] Слайдшоу отправлено в чат.")                            
-                        except Exception as send_video_err:
-                            logging.error(f"[upload_to_chat] Ошибка при отправке слайдшоу: {send_video_err}")
-                        finally:
-                            if os.path.exists(path_video_file):
-                                os.remove(path_video_file)
-
-                    await query.message.answer("Все фотографии отправлены.")
-                    await asyncio.sleep(1)
-                    await query.message.answer("Мы будем рады, если вы поделитесь с нами вашими фотографиями для публикации их в группе. Для этого можно отправить фото в этот чат")                          
-                    break     
-        except Exception as e:
-            logging.exception(f"Ошибка при отправке фото в чат: {e}")            
-            break            
+                await run_job([job['chat'] for job in jobs], send_photo_group_to_chat, chat_id, batch)
+
+            for file_path, job in zip(batch, jobs):
+                # Добавляем фото в слайдшоу, не задерживая отправку следующих
+                stage.submit(job['slideshow'], file_path)
+
+        await stage.join()
+        await run_job(video_job, send_slideshow, chat_id, slideshow, session_slideshow_folder, "upload_to_chat")
+
+        await query.message.answer("Все фотографии отправлены.")
+        await asyncio.sleep(1)
+        await query.message.answer("Мы будем рады, если вы поделитесь с нами вашими фотографиями для публикации их в группе. Для этого можно отправить фото в этот чат")                          
+    except Exception as e:
+        logging.exception(f"Ошибка при отправке фото в чат: {e}")            
+        await stage.cancel()
+        slideshow.abort()
+        await fail_video_job(video_job, session_slideshow_folder)
+    finally:
+        active_deliveries.discard(phone_number)
+        SESSIONS.inc(delivery_mode)
+        logging.info(stats.summary())
 
 
 
 # Обработчик отправки фотографий в облако
 @dp.callback_query(F.data.startswith('upload_to_cloud_'))
 async def callback_upload_to_cloud(query: types.CallbackQuery,
-                                   check_interval: int = 10, 
                                    max_wait_time: int = timeout):
-    global slideshow_folder, audio_folder
     user_id = query.from_user.id
-    user_data = get_user_folder(user_id)
+    chat_id = query.message.chat.id
+    user_data = await run_db(get_user_folder, user_id)
     phone_number = user_data[0] if user_data else ''
     folder = user_data[1] if user_data else ''
+    session_slideshow_folder = os.path.join(slideshow_folder, phone_number)
+    slideshow = SlideshowWriter(os.path.join(session_slideshow_folder, 'slideshow.mp4'))
+    stage = SlideshowStage(slideshow, session_slideshow_folder)
 
     logging.info(f"User ID: {user_id}, Phone_nimber: {phone_number}, Folder: {folder}")
   
@@ -225,109 +248,361 @@ async def callback_upload_to_cloud(query: types.CallbackQuery,
         await query.message.edit_text("На данный момент ваших фотографий нет.")
         return
 
-    disk_path = f"disk:/{phone_number}"
+    storage = get_storage()
 
     # Обновление сообщения для удаления клавиатуры
     await query.message.edit_text("После загрузки фотографий вам придет ссылка")
 
+    active_deliveries.add(phone_number)
+    photo_session = sessions.get(user_id)
+    stats = photo_session.stats if photo_session else SessionStats(phone_number)
+    set_session_stats(stats)
+    bind_log_context(session=photo_session.id if photo_session else None, user_id=user_id, phone=phone_number)
+    video_job = (await run_db(add_jobs, session_slideshow_folder, user_id, chat_id, phone_number, ('video',)))['video']
     async with aiohttp.ClientSession() as session:
-        public_link = await retry_on_failure(create_and_publish_folder, session, disk_path)
-        logging.info(f"[upload_to_cloud] Public link: {public_link}")
-
-        elapsed_time = 0  # Время, прошедшее с последней проверки, когда были файлы
-        while True:
+        try:
             try:
-                files = os.listdir(folder)
-                logging.info(f"Files found облако: {files}")
-                if files:
-                    for filename in files:
-                        file_path = os.path.join(folder, filename)
-                        if os.path.isfile(file_path):
-                            try:
-                                # Загрузка файла                        
-                                await retry_on_failure(upload_file, session, file_path, f"{disk_path}/{filename}")
-                                
-                                # Добавляем фото в папку для слайдшоу
-                                resize_photo(file_path, slideshow_folder)
-                            except Exception as send_photo_err:
-                                logging.error(f"[upload_to_cloud]  Ошибка при отправке фото в облако: {send_photo_err}")
-                            finally:
-                                if os.path.exists(file_path):
-                                    os.remove(file_path)
-                            
-                            await asyncio.sleep(1)
-                            elapsed_time = 0  # Сбрасываем счетчик времени
-                else:
-                    await asyncio.sleep(check_interval)
-                    elapsed_time += check_interval
-                    logging.info(f"Elapsed time облако: {elapsed_time}")
-                    if elapsed_time >= max_wait_time:
-                        path_video_file = create_videos(slideshow_folder, audio_folder)
-                        if path_video_file:
-                            try:
-                                with open(path_video_file, 'rb') as f:
-                                    video_data = f.read()
-
-                                video_buffered = BufferedInputFile(video_data, filename=os.path.basename(path_video_file))
-
-                                await retry_on_failure(
-                                    bot.send_document,
-                                    chat_id=query.message.chat.id,
-                                    document=video_buffered
-                                )                  
-                                logging.info(f"[upload_to_cloud] Слайдшоу отправлено в чат.")                                
-                            except Exception as send_err:
-                                logging.error(f"[upload_to_cloud] Ошибка при отправке слайдшоу: {send_err}")
-                            finally:
-                                if os.path.exists(path_video_file):
-                                    os.remove(path_video_file)
-
-                        await query.message.edit_text(f"Фотографии загружены в облако. Ссылка для скачивания: {public_link}")
-                        await asyncio.sleep(1)
-                        await query.message.answer("Мы будем рады, если вы поделитесь с нами вашими фотографиями для публикации их в группе. Для этого можно отправить фото в этот чат")
-                        break
+                with timer('create_folder'):
+                    public_link = await retry_on_failure(storage.create_and_publish_folder, session, phone_number)
+                logging.info(f"[upload_to_cloud] Public link: {public_link}")
             except Exception as e:
-                logging.exception(f"Ошибка при загрузке в облако: {e}")
-                break                      
-       
+                logging.error(f"[upload_to_cloud] Не удалось создать папку {phone_number}: {e}")
+                public_link = None
+            if public_link is None:
+                # Хранилище недоступно или не вернуло ссылку: фото ставятся в очередь повтора,
+                # ссылку пришлет фоновый повтор
+                link_job = (await run_db(add_jobs, phone_number, user_id, chat_id, phone_number, ('link',)))['link']
+                await run_db(set_job_state, link_job, 'retry')
+
+            # Фото удаляется после загрузки, если задание слайдшоу по нему тоже выполнено
+            async def on_uploaded(jobs, file_path, success):
+                if success:
+                    await run_db(set_job_state, jobs['disk'], 'done')
+                else:
+                    await run_db(fail_job, jobs['disk'])
+                await remove_if_delivered(file_path)
+
+            # Каждое фото ставится в очередь загрузки сразу после того, как PhotoHandler его принял,
+            # и одновременно уменьшается для слайдшоу
+            uploader = UploadPipeline(session, storage, phone_number)
+            async for file_path in iter_session_files(folder, photo_session, max_wait_time):
+                jobs = await run_db(add_jobs, file_path, user_id, chat_id, phone_number, ('disk', 'slideshow'))
+                stage.submit(jobs['slideshow'], file_path)
+                if public_link is None:
+                    await run_db(set_job_state, jobs['disk'], 'retry')
+                    continue
+                await uploader.submit(file_path, functools.partial(on_uploaded, jobs))
+            await uploader.join()
+            await stage.join()
+
+            await run_job(video_job, send_slideshow, chat_id, slideshow, session_slideshow_folder, "upload_to_cloud")
+
+            if public_link is None:
+                await query.message.edit_text("Облачное хранилище сейчас недоступно. Фотографии будут загружены "
+                                              "автоматически, ссылка придет отдельным сообщением")
+            else:
+                await query.message.edit_text(f"Фотографии загружены в облако. Ссылка для скачивания: {public_link}")
+            await asyncio.sleep(1)
+            await query.message.answer("Мы будем рады, если вы поделитесь с нами вашими фотографиями для публикации их в группе. Для этого можно отправить фото в этот чат")
+        except Exception as e:
+            logging.exception(f"Ошибка при загрузке в облако: {e}")
+            await stage.cancel()
+            slideshow.abort()
+            await fail_video_job(video_job, session_slideshow_folder)
+        finally:
+            active_deliveries.discard(phone_number)
+            SESSIONS.inc('cloud')
+            logging.info(stats.summary())
+
+
+
+# Ожидание допустимой частоты отправки в чат
+async def telegram_rate_limit(chat_id: int):
+    await chat_limiters[chat_id].acquire()
+    await global_limiter.acquire()
+
+
 
+# Отправка фото в чат с кнопкой получения Ч/Б версии
+@timed('send_photo')
+async def send_photo_to_chat(chat_id: int, file_path: str):
+    # Файл читается с диска частями во время отправки и открывается заново при каждой попытке
+    document = FSInputFile(file_path)
 
-# Запуск мониторинга основной папки с фотографиями
-async def start_watchdog(phone_number, photo_folder, clients_folder):
-    global user_in_session    
-    event_handler = PhotoHandler(phone_number, clients_folder)
-    observer = Observer()
-    observer.schedule(event_handler, path=photo_folder, recursive=False)
-    observer.start()
+    # Ключ для callback_data создается заранее, чтобы кнопка ушла вместе с документом
+    file_id_hash = uuid.uuid4().hex
 
+    keyboard = InlineKeyboardBuilder()
+    keyboard.button(text="Получить Ч/Б фото", callback_data=f'get_bw_{file_id_hash}')                    
+    keyboard.adjust(1)
+
+    # Отправка файла
+    await telegram_rate_limit(chat_id)
+    message = await retry_on_failure(bot.send_document, 
+                                     chat_id=chat_id, 
+                                     document=document, 
+                                     reply_markup=keyboard.as_markup()
+                                    )
+
+    # Сохранение связи хеш -> file_id и оригинала для быстрой Ч/Б версии
+    add_file_id(file_id_hash, message.document.file_id)
     try:
-        while user_in_session:
-            await asyncio.sleep(10)           
-            if datetime.now() - event_handler.last_modified > timedelta(seconds=timeout):
-                user_in_session = None
-                logging.info("Нет изменений в течение 10 минут. Остановка мониторинга.")
-                break
-    finally:
-        observer.stop()
-        observer.join()
+        # Копирование (если кеш на другом диске) не должно блокировать event loop
+        await run_in_thread(originals_cache.put, file_id_hash, file_path)
+    except OSError as e:
+        logging.error(f"[send_photo_to_chat] Не удалось сохранить оригинал {file_path} в кеш: {e}")
+
+
+
+# Отправка нескольких фото одним альбомом
+@timed('send_group')
+async def send_photo_group_to_chat(chat_id: int, file_paths: list):
+    media = [InputMediaDocument(media=FSInputFile(file_path)) for file_path in file_paths]
+
+    await telegram_rate_limit(chat_id)
+    await retry_on_failure(bot.send_media_group, chat_id=chat_id, media=media)
+
+
+
+# Уменьшение фото и добавление его кадров в слайдшоу.
+# Кадры добавляются после того, как добавлено предыдущее фото (previous).
+# Уменьшенное фото остается в папке, пока слайдшоу не завершено: если ffmpeg упадет,
+# оно попадет в create_videos. Без SlideshowWriter фото сразу собирается через create_videos
+async def add_to_slideshow(slideshow: SlideshowWriter | None, file_path: str, photo_dir: str,
+                           previous: asyncio.Task | None = None):
+    os.makedirs(photo_dir, exist_ok=True)
+    resized_path = await resize_photo_async(file_path, photo_dir)
+    if previous is not None:
+        await asyncio.wait({previous})
+    if not resized_path:
+        raise Exception(f"Не удалось подготовить {file_path} для слайдшоу")
+    if slideshow:
+        await slideshow.add_photo_async(resized_path)
+
+
+
+class SlideshowStage:
+    """Фоновое добавление фото сессии в слайдшоу: уменьшение идет в пуле процессов
+    параллельно с отправкой и загрузкой, кадры добавляются в порядке поступления фото"""
+    def __init__(self, slideshow: SlideshowWriter | None, photo_dir: str):
+        self.slideshow = slideshow
+        self.photo_dir = photo_dir
+        self.previous = None
+        self.tasks = set()
+
+    def submit(self, job_id: int, file_path: str):
+        task = asyncio.create_task(self._add(job_id, file_path, self.previous))
+        self.previous = task
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _add(self, job_id: int, file_path: str, previous: asyncio.Task | None):
+        try:
+            await run_job(job_id, add_to_slideshow, self.slideshow, file_path, self.photo_dir, previous)
+        except asyncio.CancelledError:
+            # Доставка прервана: кадр добавит фоновый повтор до сборки слайдшоу сессии
+            await run_db(fail_job, job_id)
+            raise
+        await remove_if_delivered(file_path)
+
+    # Ожидание добавления всех фото перед завершением слайдшоу
+    async def join(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+    async def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+
+# Выполнение задания доставки (или нескольких, выполняемых одним запросом)
+# с сохранением результата в очереди заданий
+async def run_job(job_id: int | list, func, *args) -> bool:
+    job_ids = job_id if isinstance(job_id, list) else [job_id]
+    try:
+        await func(*args)
+        for job_id in job_ids:
+            await run_db(set_job_state, job_id, 'done')
+        return True
+    except Exception as e:
+        logging.error(f"[run_job] Ошибка заданий {job_ids} ({func.__name__}): {e}")
+        for job_id in job_ids:
+            await run_db(fail_job, job_id)
+        return False
+
+
+
+# Фото удаляется только после выполнения всех заданий по нему
+async def remove_if_delivered(file_path: str):
+    if await run_db(count_open_jobs, file_path) == 0 and os.path.exists(file_path):
+        os.remove(file_path)
+
+
+
+# Повтор неудачных и прерванных перезапуском заданий
+async def retry_jobs():
+    jobs = await run_db(get_retry_jobs)
+    logging.debug(f"[retry_jobs] Заданий для повтора: {len(jobs)}")
+    if not jobs:
+        return
+
+    video_jobs = []
+    async with aiohttp.ClientSession() as session:
+        # Сначала папки и ссылки сессий, у которых хранилище было недоступно
+        for job_id, folder, destination, user_id, chat_id, phone_number in jobs:
+            if destination == 'link' and phone_number not in active_deliveries:
+                await run_db(set_job_state, job_id, 'pending')
+                await run_job(job_id, send_cloud_link, session, chat_id, folder)
+
+        for job_id, file_path, destination, user_id, chat_id, phone_number in jobs:
+            if destination == 'link':
+                continue
+            # Папка в хранилище еще не создана - загрузка ждет задания link
+            if destination == 'disk' and await run_db(get_job_state, phone_number, 'link') in ('retry', 'pending'):
+                continue
+            # Слайдшоу сессии отправляется после того, как в папку вернулись восстановленные кадры
+            if destination == 'video':
+                video_jobs.append((job_id, file_path, chat_id, phone_number))
+                continue
+            if not os.path.exists(file_path):
+                logging.error(f"[retry_jobs] Файл {file_path} задания {job_id} не найден")
+                await run_db(set_job_state, job_id, 'failed')
+                continue
+            # Слайдшоу активной доставки собирается ею самой
+            if destination == 'slideshow' and phone_number in active_deliveries:
+                continue
+
+            photo_dir = os.path.join(slideshow_folder, phone_number)
+            # Слайдшоу сессии уже отправлено - кадр в него не попадет
+            if destination == 'slideshow' and await run_db(get_job_state, photo_dir, 'video') not in ('retry', 'pending'):
+                await run_db(set_job_state, job_id, 'done')
+                await remove_if_delivered(file_path)
+                continue
+
+            await run_db(set_job_state, job_id, 'pending')
+            if destination == 'chat':
+                await run_job(job_id, send_photo_to_chat, chat_id, file_path)
+            elif destination == 'disk':
+                await run_job(job_id, get_storage().upload_file, session, file_path, phone_number)
+            elif destination == 'slideshow':
+                await run_job(job_id, add_to_slideshow, None, file_path, photo_dir)
+            await remove_if_delivered(file_path)
+
+    # Досылаем слайдшоу сессий, прерванных до его отправки: одно на сессию
+    for job_id, photo_dir, chat_id, phone_number in video_jobs:
+        if phone_number not in active_deliveries:
+            await run_db(set_job_state, job_id, 'pending')
+            await run_job(job_id, send_slideshow, chat_id, None, photo_dir, "retry_jobs")
+
+
+# Создание папки в хранилище и отправка ссылки на нее, если при доставке хранилище было недоступно
+async def send_cloud_link(session, chat_id: int, folder: str):
+    public_link = await retry_on_failure(get_storage().create_and_publish_folder, session, folder)
+    if not public_link:
+        raise Exception(f"Хранилище не вернуло публичную ссылку на папку {folder}")
+    await retry_on_failure(bot.send_message, chat_id=chat_id,
+                           text=f"Фотографии загружаются в облако. Ссылка для скачивания: {public_link}")
+
+
+# Доставка прервана до отправки слайдшоу - его соберет фоновый повтор
+async def fail_video_job(job_id: int, photo_dir: str):
+    if await run_db(get_job_state, photo_dir, 'video') == 'pending':
+        await run_db(fail_job, job_id)
+
+
+async def retry_jobs_loop(interval=30):
+    while True:
+        try:
+            await retry_jobs()
+        except Exception as e:
+            logging.error(f"[retry_jobs_loop] Ошибка повтора заданий: {e}")
+        await asyncio.sleep(interval)
+
+
+
+# Завершение и отправка слайдшоу по окончании сессии.
+# Ошибка отправки передается вызывающему: задание video уходит в фоновый повтор
+async def send_slideshow(chat_id: int, slideshow: SlideshowWriter | None, photo_dir: str, log_prefix: str):
+    path_video_file = await slideshow.finish_async(audio_folder) if slideshow else None
+    if not path_video_file and slideshow is None:
+        # Слайдшоу, собранное ранее, но не отправленное
+        ready_video_file = os.path.join(photo_dir, 'slideshow.mp4')
+        if os.path.exists(ready_video_file):
+            path_video_file = ready_video_file
+    if not path_video_file and (slideshow is None or slideshow.failed):
+        # Потоковое кодирование не удалось - собираем из оставшихся в папке фото
+        path_video_file = await create_videos_async(photo_dir, audio_folder)
+    if not path_video_file:
+        if os.path.isdir(photo_dir) and any(f.lower().endswith('.jpg') for f in os.listdir(photo_dir)):
+            raise Exception(f"Не удалось собрать слайдшоу из фото в {photo_dir}")
+        return
+
+    await telegram_rate_limit(chat_id)
+    with timer('send_slideshow'):
+        await retry_on_failure(
+            bot.send_document,
+            chat_id=chat_id,
+            document=FSInputFile(path_video_file)
+        )
+    logging.info(f"[{log_prefix}] Слайдшоу отправлено в чат.")
+    # Видео удаляется только после отправки: при ошибке его отправит фоновый повтор
+    os.remove(path_video_file)
 
 
 
 async def main():
+    originals_cache.clear()
+    # Профилирование (PROFILING=1) подключается до роутера handlers.py
+    setup_profiling(dp)
     dp.include_router(router)
-    await dp.start_polling(bot)
+    start_loop_monitor()
+
+    # Фоновая синхронизация справочника номеров YCLIENTS
+    sync_task = asyncio.create_task(client_phones_sync_loop())
+    # Фоновая запись отложенных file_id
+    flush_task = asyncio.create_task(file_ids_flush_loop())
+    # Удаление устаревших file_id и сжатие базы
+    maintenance_task = asyncio.create_task(db_maintenance_loop())
+    # Задания, прерванные перезапуском, и неудачные доставки повторяются в фоне
+    resumed = await run_db(reset_pending_jobs)
+    if resumed:
+        logging.info(f"Возобновлено заданий после перезапуска: {resumed}")
+    retry_task = asyncio.create_task(retry_jobs_loop())
+    # Страница метрик для Prometheus
+    await start_metrics_server()
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(dp, bot)
+        else:
+            # Webhook, оставшийся после запуска в режиме webhook, не дает получать обновления через getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        sync_task.cancel()
+        flush_task.cancel()
+        maintenance_task.cancel()
+        retry_task.cancel()
+        sessions.stop()
+        shutdown_workers()
+        await stop_metrics_server()
+        stop_loop_monitor()
+        await close_http_client()
+        close_db()
 
 
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        filename='app.log',
-        filemode='w'
-    )
+    # Необходимо для пула процессов в собранном pyinstaller exe
+    multiprocessing.freeze_support()
+    # Запись в app.log с ротацией из отдельного потока
+    setup_logging()
     try:
         asyncio.run(main())
     except Exception as err:
         logging.error(f"Ошибка: {err}")
+    finally:
+        stop_logging()
         
\ No newline at end of file
@@ -0,0 +1,213 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from collections import defaultdict
+from aiohttp import web
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+# Адрес страницы метрик в формате Prometheus (порт 0 - не запускать)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+
+# Границы корзин гистограмм времени (сек): от запросов к базе до сборки слайдшоу
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_metrics_runner = None
+# Сводка текущей сессии; наследуется задачами, созданными в обработчике доставки
+_session_stats = contextvars.ContextVar('session_stats', default=None)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = [*zip(labelnames, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """Счетчик, только увеличивается"""
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] += amount
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                for labels, value in sorted(values.items())]
+
+
+class Histogram:
+    """Гистограмма длительностей с накопительными корзинами, как в Prometheus"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики корзин..., количество, сумма]
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += 1
+            data[-1] += value
+
+    def render(self):
+        with self.lock:
+            values = {labels: list(data) for labels, data in self.values.items()}
+        lines = []
+        for labels, data in sorted(values.items()):
+            for bound, count in zip(self.buckets, data):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', '+Inf')])} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {data[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {data[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram('zerkalo_stage_seconds', 'Длительность этапов обработки фото', ('stage',))
+STAGE_ERRORS = Counter('zerkalo_stage_errors_total', 'Ошибки этапов обработки фото', ('stage',))
+PHOTOS = Counter('zerkalo_photos_total', 'Фото с камеры по результату проверки', ('result',))
+UPLOADED_BYTES = Counter('zerkalo_uploaded_bytes_total', 'Байт загружено в облачное хранилище')
+SESSIONS = Counter('zerkalo_sessions_total', 'Завершенные доставки фото', ('mode',))
+
+
+class SessionStats:
+    """Сводка по этапам одной сессии: количество, суммарное и максимальное время"""
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        # stage -> [количество, сумма, максимум, ошибки]
+        self.stages = defaultdict(lambda: [0, 0.0, 0.0, 0])
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, error=False):
+        with self.lock:
+            data = self.stages[stage]
+            data[0] += 1
+            data[1] += seconds
+            data[2] = max(data[2], seconds)
+            data[3] += error
+
+    def summary(self) -> str:
+        with self.lock:
+            stages = sorted(((stage, list(data)) for stage, data in self.stages.items()),
+                            key=lambda item: item[1][1], reverse=True)
+        parts = [f"{stage}: {count} x {total / count:.3f} с (макс {peak:.3f}, всего {total:.1f}"
+                 + (f", ошибок {errors})" if errors else ")")
+                 for stage, (count, total, peak, errors) in stages]
+        return (f"[metrics] Сессия {self.name}, {time.monotonic() - self.started:.1f} с. "
+                + ('; '.join(parts) or 'нет данных'))
+
+
+def set_session_stats(stats: SessionStats | None):
+    _session_stats.set(stats)
+
+
+# Замер этапа: гистограмма по всем сессиям и сводка сессии (явная или текущая из контекста)
+@contextmanager
+def timer(stage, stats: SessionStats | None = None):
+    stats = stats or _session_stats.get()
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        logging.debug(f"[metrics] {stage}: {elapsed:.3f} с", extra={'stage': stage, 'duration': elapsed})
+        STAGE_SECONDS.observe(elapsed, stage)
+        if error:
+            STAGE_ERRORS.inc(stage)
+        if stats is not None:
+            stats.record(stage, elapsed, error)
+
+
+# Декоратор для синхронных и асинхронных функций
+def timed(stage):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _metrics_handler(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    global _metrics_runner
+    if not port or _metrics_runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Порт занят (например, другим экземпляром бота) - бот работает без страницы метрик
+        logging.error(f"[metrics] Не удалось запустить страницу метрик на {host}:{port}: {e}")
+        await runner.cleanup()
+        return
+    _metrics_runner = runner
+    logging.info(f"[metrics] Метрики доступны на http://{host}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
@@ -0,0 +1,210 @@
+import io
+import os
+import sys
+import time
+import pstats
+import marshal
+import asyncio
+import cProfile
+import logging
+import threading
+import traceback
+from aiogram import BaseMiddleware, Router, F
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, BufferedInputFile
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+# Режим профилирования (PROFILING=1): время обработчиков, медленные вызовы, задержки event loop
+PROFILING = os.getenv('PROFILING', '0') == '1'
+# Порог медленного обработчика или задачи пула (сек)
+SLOW_CALL_THRESHOLD = float(os.getenv('SLOW_CALL_THRESHOLD', 2))
+# Период проверки event loop и задержка, после которой loop считается заблокированным (сек)
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.1))
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.5))
+# Пользователи, которым доступна команда /profile, через ","
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()}
+
+router = Router()
+_profile_lock = asyncio.Lock()
+_loop_monitor = None
+
+
+def format_thread_stack(thread_id) -> str:
+    frame = sys._current_frames().get(thread_id)
+    return ''.join(traceback.format_stack(frame)) if frame else 'поток завершен'
+
+
+def format_task_stack(task) -> str:
+    buffer = io.StringIO()
+    task.print_stack(file=buffer)
+    return buffer.getvalue()
+
+
+class slow_call:
+    """Контекст вызова, о котором пишется предупреждение со стеком, если он идет дольше threshold.
+    Стек снимается в момент превышения: для задачи пула потоков - стек ее потока (thread_id),
+    иначе - место, где ждет текущая задача asyncio"""
+    def __init__(self, name, threshold=SLOW_CALL_THRESHOLD):
+        self.name = name
+        self.threshold = threshold
+        self.thread_id = None
+        self.handle = None
+
+    def report(self, task):
+        if self.thread_id is not None:
+            stack = f"Стек потока:\n{format_thread_stack(self.thread_id)}"
+        else:
+            stack = f"Стек задачи:\n{format_task_stack(task)}" if task else ''
+        logging.warning(f"[profiling] {self.name} выполняется дольше {self.threshold} с. {stack}")
+
+    async def __aenter__(self):
+        self.started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        self.handle = loop.call_later(self.threshold, self.report, asyncio.current_task())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.handle.cancel()
+        elapsed = time.perf_counter() - self.started
+        if elapsed > self.threshold:
+            logging.warning(f"[profiling] {self.name} завершился за {elapsed:.2f} с")
+
+    # Обертка функции для пула потоков: запоминает поток, в котором она выполняется
+    def bind(self, func):
+        def wrapper():
+            self.thread_id = threading.get_ident()
+            try:
+                return func()
+            finally:
+                self.thread_id = None
+        return wrapper
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Время каждого вызова обработчика; медленные вызовы пишутся в лог со стеком"""
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        async with slow_call(f"Обработчик {name}"):
+            started = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                logging.debug(f"[profiling] {name}: {time.perf_counter() - started:.3f} с")
+
+
+class LoopLagMonitor:
+    """Задержки event loop. Задача в loop обновляет отметку каждые interval секунд;
+    отдельный поток, заметив, что отметка не обновлялась дольше threshold,
+    пишет в лог стек потока loop - то есть блокирующий вызов в момент блокировки"""
+    def __init__(self, interval=LOOP_LAG_INTERVAL, threshold=LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.max_lag = 0.0
+        self.stopped = threading.Event()
+        self.task = None
+        self.thread = None
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self._beat())
+        self.thread = threading.Thread(target=self._watch, name='loop-lag-monitor', daemon=True)
+        self.thread.start()
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = now - expected
+            self.heartbeat = now
+            if lag > self.threshold:
+                self.max_lag = max(self.max_lag, lag)
+                logging.warning(f"[profiling] Event loop был заблокирован {lag:.2f} с")
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.interval):
+            heartbeat = self.heartbeat
+            if time.monotonic() - heartbeat > self.threshold and reported != heartbeat:
+                # Одна запись на каждую блокировку
+                reported = heartbeat
+                logging.warning(f"[profiling] Event loop не отвечает дольше {self.threshold} с. "
+                                f"Стек потока loop:\n{format_thread_stack(self.loop_thread_id)}")
+
+    def stop(self):
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+
+
+# Снимок cProfile потока event loop за seconds секунд: текст pstats и файл .prof
+async def profile_snapshot(seconds: float, limit=40) -> tuple[str, bytes]:
+    profiler = cProfile.Profile()
+    async with _profile_lock:
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+
+    text = io.StringIO()
+    stats = pstats.Stats(profiler, stream=text)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(limit)
+    # marshal-формат для snakeviz и pstats.Stats(path)
+    profiler.create_stats()
+    return text.getvalue(), marshal.dumps(profiler.stats)
+
+
+# /profile [секунды] - снимок профиля, доступен пользователям из ADMIN_IDS
+@router.message(Command('profile'), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_profile(message: Message, command: CommandObject):
+    try:
+        seconds = float(command.args) if command.args else 30
+    except ValueError:
+        await message.answer("Использование: /profile [секунды]")
+        return
+    if _profile_lock.locked():
+        await message.answer("Профилирование уже выполняется")
+        return
+
+    await message.answer(f"Профилирование {seconds:g} с...")
+    text, data = await profile_snapshot(seconds)
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    await message.answer_document(BufferedInputFile(text.encode(), filename=f'profile_{stamp}.txt'))
+    await message.answer_document(BufferedInputFile(data, filename=f'profile_{stamp}.prof'))
+    max_lag = _loop_monitor.max_lag if _loop_monitor else 0
+    await message.answer(f"Наибольшая задержка event loop: {max_lag:.2f} с")
+
+
+# Подключение к диспетчеру: до остальных роутеров, чтобы /profile не перехватил обработчик текста
+def setup_profiling(dp):
+    if not PROFILING:
+        return
+    dp.message.middleware(HandlerTimingMiddleware())
+    dp.callback_query.middleware(HandlerTimingMiddleware())
+    dp.include_router(router)
+    logging.info(f"[profiling] Профилирование включено: порог {SLOW_CALL_THRESHOLD} с, "
+                 f"задержка loop {LOOP_LAG_THRESHOLD} с, администраторы {sorted(ADMIN_IDS)}")
+
+
+def start_loop_monitor():
+    global _loop_monitor
+    if PROFILING and _loop_monitor is None:
+        _loop_monitor = LoopLagMonitor()
+        _loop_monitor.start()
+
+
+def stop_loop_monitor():
+    global _loop_monitor
+    if _loop_monitor is not None:
+        _loop_monitor.stop()
+        _loop_monitor = None
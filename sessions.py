@@ -0,0 +1,205 @@
+import os
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from watchdog.observers import Observer
+from dotenv import load_dotenv
+
+from utils import PhotoHandler, shutdown_ingest_pool
+from metrics import SessionStats
+
+
+load_dotenv()
+
+
+# Папки, в которые пишут камеры фотозон, через ";"
+CAMERA_FOLDERS = [f for f in os.getenv('CAMERA_FOLDERS', r'C:\photo').split(';') if f]
+# Максимальное количество одновременных сессий (по умолчанию - по числу камер)
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', len(CAMERA_FOLDERS)))
+
+
+class Session:
+    """Фотосессия одного пользователя на одной камере"""
+    def __init__(self, user_id, phone_number, camera_folder, clients_folder, slideshow_folder, timeout):
+        # Идентификатор сессии для записей лога
+        self.id = uuid.uuid4().hex[:8]
+        self.user_id = user_id
+        self.phone_number = phone_number
+        self.camera_folder = camera_folder
+        self.folder = os.path.join(clients_folder, phone_number)
+        self.slideshow_folder = os.path.join(slideshow_folder, phone_number)
+        self.timeout = timeout
+        # Новые фото сессии поступают из потока watchdog в эту очередь
+        self.queue = asyncio.Queue()
+        # Время этапов сессии: от приема фото до отправки слайдшоу
+        self.stats = SessionStats(phone_number)
+        self.handler = PhotoHandler(phone_number, clients_folder, asyncio.get_running_loop(), self.queue,
+                                    stats=self.stats, session_id=self.id)
+        self.watch = None
+        self.task = None
+        self.started = datetime.now()
+
+    @property
+    def last_modified(self):
+        return self.handler.last_modified
+
+    # Сколько секунд осталось до завершения сессии без новых фото
+    def time_left(self):
+        return self.timeout - (datetime.now() - self.last_modified).total_seconds()
+
+    def is_expired(self):
+        return self.time_left() <= 0
+
+
+# Асинхронный генератор файлов сессии: сначала уже лежащие в папке, затем новые из очереди.
+# Завершается, когда с последнего фото или отправки прошло max_wait_time секунд
+async def iter_session_files(folder, session=None, max_wait_time=600):
+    seen = set()
+    last_activity = datetime.now()
+
+    for filename in sorted(os.listdir(folder)):
+        file_path = os.path.join(folder, filename)
+        if os.path.isfile(file_path):
+            seen.add(file_path)
+            yield file_path
+            last_activity = datetime.now()
+
+    if session is None:
+        return
+
+    while True:
+        if session.last_modified > last_activity:
+            last_activity = session.last_modified
+        remaining = max_wait_time - (datetime.now() - last_activity).total_seconds()
+        if remaining <= 0:
+            break
+
+        try:
+            file_path = await asyncio.wait_for(session.queue.get(), timeout=remaining)
+        except asyncio.TimeoutError:
+            continue
+
+        if file_path in seen or not os.path.isfile(file_path):
+            continue
+        seen.add(file_path)
+        logging.debug(f"[iter_session_files] Новое фото {file_path}")
+        yield file_path
+        last_activity = datetime.now()
+
+
+# Группировка файлов в пачки до max_size штук; неполная пачка отдается,
+# если с момента ее первого файла прошло max_wait секунд
+async def batch_files(files, max_size, max_wait):
+    loop = asyncio.get_running_loop()
+    batch = []
+    deadline = None
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(files.__anext__())
+            timeout = max(0, deadline - loop.time()) if batch else None
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if not done:
+                yield batch
+                batch = []
+                continue
+
+            finished, pending = pending, None
+            try:
+                file_path = finished.result()
+            except StopAsyncIteration:
+                break
+
+            batch.append(file_path)
+            if len(batch) == 1:
+                deadline = loop.time() + max_wait
+            if len(batch) >= max_size:
+                yield batch
+                batch = []
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+    if batch:
+        yield batch
+
+
+class SessionManager:
+    """Хранит активные сессии по пользователю и по папке камеры"""
+    def __init__(self, camera_folders=CAMERA_FOLDERS, max_sessions=MAX_SESSIONS):
+        self.camera_folders = camera_folders
+        self.max_sessions = min(max_sessions, len(camera_folders))
+        self.by_user = {}
+        self.by_camera = {}
+        self.observer = None
+
+    def get(self, user_id):
+        return self.by_user.get(user_id)
+
+    def free_camera(self):
+        if len(self.by_user) >= self.max_sessions:
+            return None
+        for camera_folder in self.camera_folders:
+            if camera_folder not in self.by_camera:
+                return camera_folder
+        return None
+
+    # Запуск сессии: None, если все камеры заняты
+    def start_session(self, user_id, phone_number, clients_folder, slideshow_folder, timeout):
+        session = self.by_user.get(user_id)
+        if session:
+            return session
+
+        camera_folder = self.free_camera()
+        if camera_folder is None:
+            return None
+
+        session = Session(user_id, phone_number, camera_folder, clients_folder, slideshow_folder, timeout)
+        os.makedirs(session.folder, exist_ok=True)
+        os.makedirs(session.slideshow_folder, exist_ok=True)
+
+        if self.observer is None:
+            self.observer = Observer()
+            self.observer.start()
+        session.watch = self.observer.schedule(session.handler, path=camera_folder, recursive=False)
+
+        self.by_user[user_id] = session
+        self.by_camera[camera_folder] = session
+        session.task = asyncio.create_task(self._watch_session(session))
+        logging.info(f"[SessionManager] Сессия {phone_number} запущена на {camera_folder}. "
+                     f"Активных сессий: {len(self.by_user)}")
+        return session
+
+    def close_session(self, session):
+        if self.by_user.get(session.user_id) is session:
+            del self.by_user[session.user_id]
+        if self.by_camera.get(session.camera_folder) is session:
+            del self.by_camera[session.camera_folder]
+        if self.observer is not None and session.watch is not None:
+            self.observer.unschedule(session.watch)
+            session.watch = None
+        logging.info(f"[SessionManager] Сессия {session.phone_number} на {session.camera_folder} завершена. "
+                     f"Активных сессий: {len(self.by_user)}")
+
+    # Мониторинг сессии до истечения таймаута без новых фото
+    async def _watch_session(self, session):
+        try:
+            while not session.is_expired():
+                await asyncio.sleep(max(session.time_left(), 1))
+            logging.info(f"Нет изменений в течение {session.timeout} секунд. Остановка мониторинга {session.camera_folder}.")
+        finally:
+            self.close_session(session)
+
+    def stop(self):
+        for session in list(self.by_user.values()):
+            if session.task:
+                session.task.cancel()
+            self.close_session(session)
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+        shutdown_ingest_pool()
@@ -0,0 +1,202 @@
+import os
+import logging
+import tempfile
+import subprocess
+import threading
+from PIL import Image
+
+from utils import (choose_audio,
+                   video_maxrate,
+                   x264_params,
+                   PHOTO_DURATION,
+                   SLIDESHOW_FPS,
+                   AUDIO_BITRATE_KBPS,
+                   TELEGRAM_FILE_LIMIT_MB,
+                   FFMPEG_BINARY
+                )
+from workers import run_in_thread
+from metrics import timed
+
+
+# Ожидаемая максимальная длина сессии: по ней ограничивается битрейт потокового кодирования
+SLIDESHOW_MAX_PHOTOS = int(os.getenv('SLIDESHOW_MAX_PHOTOS', 600))
+# Сколько последних символов вывода ffmpeg попадает в лог при ошибке
+FFMPEG_LOG_TAIL = 2000
+
+
+class SlideshowWriter:
+    """Инкрементальное слайдшоу: кадры каждого фото сразу передаются
+    в постоянно запущенный процесс ffmpeg, в конце сессии остается только наложить звук.
+    Уменьшенные фото удаляются только после успешного завершения, до этого по ним
+    можно собрать слайдшоу заново через create_videos"""
+    def __init__(self, output_path, width=1920, height=1080, fps=SLIDESHOW_FPS, photo_duration=PHOTO_DURATION):
+        self.output_path = output_path
+        self.video_path = output_path.replace('.mp4', '_video.mp4')
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.frames_per_photo = max(1, round(fps * photo_duration))
+        # Длительность заранее неизвестна - ограничиваем битрейт по максимальной длине сессии
+        self.maxrate = video_maxrate(SLIDESHOW_MAX_PHOTOS * photo_duration)
+        self.process = None
+        self.stderr = None
+        self.frames = []
+        self.photos = 0
+        self.failed = False
+        # Фото могут добавляться из нескольких потоков одновременно
+        self.lock = threading.Lock()
+
+    @property
+    def duration(self):
+        return self.photos * self.frames_per_photo / self.fps
+
+    def start(self):
+        command = [
+            FFMPEG_BINARY, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', f'{self.width}x{self.height}', '-r', str(self.fps),
+            '-i', '-',
+            '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+            *x264_params(self.maxrate),
+            '-threads', '2',
+            self.video_path
+        ]
+        # Вывод ffmpeg пишется во временный файл: через PIPE он мог бы заблокировать процесс
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL, stderr=self.stderr)
+
+    def ffmpeg_output(self) -> str:
+        if self.stderr is None:
+            return ''
+        self.stderr.seek(0)
+        return self.stderr.read().decode(errors='ignore')[-FFMPEG_LOG_TAIL:].strip()
+
+    def _remove_frames(self):
+        for image_path in self.frames:
+            if os.path.exists(image_path):
+                os.remove(image_path)
+        self.frames = []
+
+    # Кадр фото по центру черного фона, как при concatenate_videoclips(method='compose')
+    def _frame(self, image_path):
+        with Image.open(image_path) as img:
+            img = img.convert('RGB')
+            img.thumbnail((self.width, self.height), Image.Resampling.LANCZOS)
+            frame = Image.new('RGB', (self.width, self.height))
+            frame.paste(img, ((self.width - img.width) // 2, (self.height - img.height) // 2))
+            return frame.tobytes()
+
+    def add_photo(self, image_path) -> bool:
+        if self.failed:
+            return False
+        try:
+            frame = self._frame(image_path)
+        except Exception as e:
+            logging.error(f"[SlideshowWriter] Ошибка при чтении {image_path}: {e}")
+            return False
+
+        try:
+            with self.lock:
+                if self.failed:
+                    return False
+                if self.process is None:
+                    try:
+                        self.start()
+                    except OSError as e:
+                        # ffmpeg не найден или не запустился - слайдшоу соберется через create_videos
+                        logging.error(f"[SlideshowWriter] Не удалось запустить ffmpeg: {e}")
+                        self.failed = True
+                        self.abort()
+                        return False
+                for _ in range(self.frames_per_photo):
+                    self.process.stdin.write(frame)
+                self.photos += 1
+                self.frames.append(image_path)
+            return True
+        except OSError as e:
+            # ffmpeg упал - дальше слайдшоу собирается из папки через create_videos
+            if self.process is not None and self.process.poll() is None:
+                self.process.wait()
+            logging.error(f"[SlideshowWriter] Ошибка записи в ffmpeg: {e}. Вывод ffmpeg: {self.ffmpeg_output()}")
+            self.failed = True
+            self.abort()
+            return False
+
+    # Завершение кодирования видео и наложение зацикленного звука
+    def finish(self, audio_dir) -> str | None:
+        if self.process is None or self.failed:
+            return None
+
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            logging.error(f"[SlideshowWriter] ffmpeg завершился с кодом {self.process.returncode}: "
+                          f"{self.ffmpeg_output()}")
+            self.failed = True
+            self.abort()
+            return None
+
+        try:
+            audio_file = choose_audio(audio_dir)
+            if not audio_file:
+                # Слайдшоу не собрать и из папки - кадры больше не нужны
+                self._remove_frames()
+                return None
+
+            # Сессия оказалась длиннее ожидаемой и видео не помещается в лимит -
+            # перекодируем с битрейтом по фактической длительности
+            video_kbps = os.path.getsize(self.video_path) * 8 / 1000 / self.duration
+            maxrate = video_maxrate(self.duration)
+            if video_kbps > maxrate:
+                logging.info(f"[SlideshowWriter] Видео {video_kbps:.0f}k больше лимита {maxrate}k, перекодирование")
+                video_codec = ['libx264', '-preset', 'veryfast', *x264_params(maxrate)]
+            else:
+                video_codec = ['copy']
+
+            command = [
+                FFMPEG_BINARY, '-y', '-loglevel', 'error',
+                '-i', self.video_path,
+                '-stream_loop', '-1', '-i', audio_file,
+                '-map', '0:v', '-map', '1:a',
+                '-c:v', *video_codec,
+                '-c:a', 'aac', '-b:a', f'{AUDIO_BITRATE_KBPS}k',
+                '-shortest',
+                self.output_path
+            ]
+            subprocess.run(command, check=True, capture_output=True)
+            self._remove_frames()
+            file_size = os.path.getsize(self.output_path) / (1024 * 1024)
+            logging.info(f"[SlideshowWriter] Слайдшоу из {self.photos} фото: {self.output_path}, {file_size:.2f} МБ")
+            if file_size > TELEGRAM_FILE_LIMIT_MB:
+                logging.warning(f"[SlideshowWriter] Размер слайдшоу превышает {TELEGRAM_FILE_LIMIT_MB} МБ")
+            return self.output_path
+        except subprocess.CalledProcessError as e:
+            logging.error(f"[SlideshowWriter] Ошибка при наложении звука: {e.stderr.decode(errors='ignore')}")
+            # Слайдшоу соберется заново из сохраненных кадров
+            self.failed = True
+            return None
+        finally:
+            self.stderr.close()
+            self.stderr = None
+            if os.path.exists(self.video_path):
+                os.remove(self.video_path)
+
+    # Остановка ffmpeg; кадры остаются в папке для create_videos или фонового повтора
+    def abort(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+        if self.stderr is not None:
+            self.stderr.close()
+            self.stderr = None
+        if os.path.exists(self.video_path):
+            os.remove(self.video_path)
+
+    @timed('slideshow_frames')
+    async def add_photo_async(self, image_path) -> bool:
+        return await run_in_thread(self.add_photo, image_path)
+
+    @timed('slideshow_finish')
+    async def finish_async(self, audio_dir) -> str | None:
+        return await run_in_thread(self.finish, audio_dir)
@@ -0,0 +1,274 @@
+import os
+import hmac
+import shutil
+import hashlib
+import logging
+import aiofiles
+from datetime import datetime, timezone
+from urllib.parse import quote
+from yarl import URL
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+# Хранилище для загрузки фото в облако: yandex, s3 или local
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'yandex')
+
+TOKEN = os.getenv("YANDEX")
+YANDEX_API_URL = os.getenv('YANDEX_API_URL', 'https://cloud-api.yandex.net/v1/disk')
+
+# Локальное хранилище: папка и адрес, по которому она раздается (для тестов и замеров без сети)
+LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT', 'storage')
+LOCAL_STORAGE_URL = os.getenv('LOCAL_STORAGE_URL', '')
+
+# S3-совместимое хранилище (Yandex Object Storage, MinIO и т.п.)
+S3_ENDPOINT = os.getenv('S3_ENDPOINT', 'https://storage.yandexcloud.net')
+S3_REGION = os.getenv('S3_REGION', 'ru-central1')
+S3_BUCKET = os.getenv('S3_BUCKET', '')
+S3_ACCESS_KEY = os.getenv('S3_ACCESS_KEY', '')
+S3_SECRET_KEY = os.getenv('S3_SECRET_KEY', '')
+# Адрес, по которому бакет доступен клиентам (по умолчанию endpoint/bucket)
+S3_PUBLIC_URL = os.getenv('S3_PUBLIC_URL', '')
+
+_storage = None
+
+
+# Чтение файла частями, чтобы не держать его целиком в памяти
+async def read_file_chunks(file_path, chunk_size=256 * 1024):
+    async with aiofiles.open(file_path, 'rb') as f:
+        while chunk := await f.read(chunk_size):
+            yield chunk
+
+
+class StorageError(Exception):
+    """Ошибочный ответ хранилища. status и retry_after учитываются при повторе запроса"""
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @classmethod
+    async def from_response(cls, resp, message):
+        error = await resp.text()
+        return cls(f"{message}: {resp.status} {error}", resp.status, resp.headers.get('Retry-After'))
+
+
+class Storage:
+    """Облачное хранилище фото клиентов. Папка называется по номеру телефона,
+    все запросы выполняются через переданную aiohttp.ClientSession"""
+    name = 'storage'
+
+    async def create_folder(self, session, folder: str):
+        raise NotImplementedError
+
+    async def publish(self, session, folder: str):
+        raise NotImplementedError
+
+    async def get_public_link(self, session, folder: str) -> str | None:
+        raise NotImplementedError
+
+    # Адрес для загрузки файла; запрашивается заранее, пока загружаются предыдущие файлы
+    async def get_upload_url(self, session, folder: str, filename: str) -> str:
+        raise NotImplementedError
+
+    # Загрузка файла потоком по полученному адресу
+    async def upload_stream(self, session, upload_url: str, file_path: str):
+        raise NotImplementedError
+
+    async def create_and_publish_folder(self, session, folder: str) -> str | None:
+        await self.create_folder(session, folder)
+        await self.publish(session, folder)
+        return await self.get_public_link(session, folder)
+
+    async def upload_file(self, session, file_path: str, folder: str):
+        upload_url = await self.get_upload_url(session, folder, os.path.basename(file_path))
+        await self.upload_stream(session, upload_url, file_path)
+
+
+class YandexDiskStorage(Storage):
+    """Яндекс.Диск через REST API"""
+    name = 'yandex'
+
+    def __init__(self, token=TOKEN, api_url=YANDEX_API_URL):
+        self.api_url = api_url.rstrip('/')
+        self.headers = {"Authorization": f"OAuth {token}"}
+
+    @staticmethod
+    def disk_path(folder, filename=None):
+        path = f"disk:/{folder}/{filename}" if filename else f"disk:/{folder}"
+        return path.replace("+", "%2B")
+
+    async def create_folder(self, session, folder):
+        url = f"{self.api_url}/resources?path={self.disk_path(folder)}"
+        async with session.put(url, headers=self.headers) as resp:
+            if resp.status == 201:
+                logging.info(f"Папка {folder} создана.")
+            elif resp.status == 409:
+                logging.info(f"Папка {folder} уже существует.")
+            else:
+                raise await StorageError.from_response(resp, "Ошибка при создании папки на Яндекс.Диске")
+
+    async def publish(self, session, folder):
+        url = f"{self.api_url}/resources/publish?path={self.disk_path(folder)}"
+        async with session.put(url, headers=self.headers) as resp:
+            if resp.status != 200:
+                raise await StorageError.from_response(resp, "Ошибка при открытии доступа к папке на Яндекс.Диске")
+        logging.info(f"Папка {folder} теперь публичная.")
+
+    async def get_public_link(self, session, folder):
+        url = f"{self.api_url}/resources?path={self.disk_path(folder)}"
+        async with session.get(url, headers=self.headers) as resp:
+            if resp.status != 200:
+                raise await StorageError.from_response(resp, "Ошибка при получении информации о ресурсе на Яндекс.Диске")
+            data = await resp.json()
+            return data.get('public_url')
+
+    async def get_upload_url(self, session, folder, filename):
+        # Повтор задания после сбоя или потерянного ответа перезаписывает уже загруженный файл, а не получает 409
+        url = f"{self.api_url}/resources/upload?path={self.disk_path(folder, filename)}&overwrite=true"
+        async with session.get(url, headers=self.headers) as resp:
+            if resp.status == 200:
+                return (await resp.json())['href']
+            raise await StorageError.from_response(resp, "Ошибка при получении ссылки загрузки на Яндекс.Диск")
+
+    async def upload_stream(self, session, upload_url, file_path):
+        headers = {"Content-Length": str(os.path.getsize(file_path))}
+        async with session.put(upload_url, data=read_file_chunks(file_path), headers=headers) as upload_resp:
+            if upload_resp.status not in (201, 202):
+                raise await StorageError.from_response(upload_resp, "Ошибка при загрузке файла на Яндекс.Диск")
+        logging.info(f"Файл {file_path} успешно загружен на Яндекс.Диск.")
+
+
+class LocalStorage(Storage):
+    """Папка на локальном диске вместо облака: для замеров и отладки без сети.
+    Публичная ссылка - base_url/папка, если папка раздается веб-сервером, иначе file://"""
+    name = 'local'
+
+    def __init__(self, root=LOCAL_STORAGE_ROOT, base_url=LOCAL_STORAGE_URL):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip('/')
+
+    async def create_folder(self, session, folder):
+        os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+
+    async def publish(self, session, folder):
+        pass
+
+    async def get_public_link(self, session, folder):
+        if self.base_url:
+            return f"{self.base_url}/{quote(folder)}/"
+        return URL.build(scheme='file', path=os.path.join(self.root, folder)).human_repr()
+
+    async def get_upload_url(self, session, folder, filename):
+        return os.path.join(self.root, folder, filename)
+
+    async def upload_stream(self, session, upload_url, file_path):
+        # Запись во временный файл, чтобы прерванная загрузка не оставила половину фото
+        partial_path = upload_url + '.part'
+        async with aiofiles.open(partial_path, 'wb') as f:
+            async for chunk in read_file_chunks(file_path):
+                await f.write(chunk)
+        shutil.move(partial_path, upload_url)
+
+
+class S3Storage(Storage):
+    """S3-совместимое хранилище. Запросы подписываются AWS Signature V4 без хеша тела
+    (UNSIGNED-PAYLOAD), поэтому файл передается потоком без предварительного чтения.
+    Объекты загружаются с ACL public-read, ссылка ведет на префикс папки"""
+    name = 's3'
+
+    def __init__(self, endpoint=S3_ENDPOINT, bucket=S3_BUCKET, access_key=S3_ACCESS_KEY,
+                 secret_key=S3_SECRET_KEY, region=S3_REGION, public_url=S3_PUBLIC_URL):
+        self.endpoint = endpoint.rstrip('/')
+        self.host = URL(self.endpoint).raw_authority
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.public_url = (public_url or f"{self.endpoint}/{bucket}").rstrip('/')
+
+    def object_path(self, key):
+        return f"/{self.bucket}/{quote(key, safe='/~')}"
+
+    def _sign(self, key, msg):
+        return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+    # Заголовки запроса с подписью AWS Signature V4 (path-style адресация)
+    def signed_headers(self, method, path, headers=None, payload_hash='UNSIGNED-PAYLOAD'):
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        date = now.strftime('%Y%m%d')
+        headers = {**(headers or {}),
+                   'host': self.host,
+                   'x-amz-date': amz_date,
+                   'x-amz-content-sha256': payload_hash}
+
+        names = sorted(name.lower() for name in headers)
+        lower = {name.lower(): str(value).strip() for name, value in headers.items()}
+        canonical_headers = ''.join(f"{name}:{lower[name]}\n" for name in names)
+        signed_names = ';'.join(names)
+        canonical_request = '\n'.join([method, path, '', canonical_headers, signed_names, payload_hash])
+
+        scope = f"{date}/{self.region}/s3/aws4_request"
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+        key = self._sign(f"AWS4{self.secret_key}".encode(), date)
+        for part in (self.region, 's3', 'aws4_request'):
+            key = self._sign(key, part)
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        headers['Authorization'] = (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                                    f"SignedHeaders={signed_names}, Signature={signature}")
+        del headers['host']
+        return headers
+
+    # В S3 нет папок: создается пустой объект "папка/", чтобы префикс был виден в списке
+    async def create_folder(self, session, folder):
+        path = self.object_path(f"{folder}/")
+        headers = self.signed_headers('PUT', path, {'Content-Length': '0'})
+        async with session.put(URL(self.endpoint + path, encoded=True), headers=headers) as resp:
+            if resp.status != 200:
+                raise await StorageError.from_response(resp, "Ошибка при создании папки в S3")
+        logging.info(f"Папка {folder} создана в бакете {self.bucket}.")
+
+    # Доступ открывается для каждого объекта при загрузке
+    async def publish(self, session, folder):
+        pass
+
+    async def get_public_link(self, session, folder):
+        return f"{self.public_url}/{quote(folder)}/"
+
+    async def get_upload_url(self, session, folder, filename):
+        return self.object_path(f"{folder}/{filename}")
+
+    async def upload_stream(self, session, upload_url, file_path):
+        headers = self.signed_headers('PUT', upload_url, {
+            'Content-Length': str(os.path.getsize(file_path)),
+            'Content-Type': 'image/jpeg',
+            'x-amz-acl': 'public-read',
+        })
+        async with session.put(URL(self.endpoint + upload_url, encoded=True),
+                               data=read_file_chunks(file_path), headers=headers) as resp:
+            if resp.status != 200:
+                raise await StorageError.from_response(resp, "Ошибка при загрузке файла в S3")
+        logging.info(f"Файл {file_path} успешно загружен в бакет {self.bucket}.")
+
+
+STORAGES = {
+    YandexDiskStorage.name: YandexDiskStorage,
+    LocalStorage.name: LocalStorage,
+    S3Storage.name: S3Storage,
+}
+
+
+# Хранилище, выбранное в STORAGE_BACKEND (создается один раз)
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND not in STORAGES:
+            raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND}")
+        _storage = STORAGES[STORAGE_BACKEND]()
+        logging.info(f"[storage] Хранилище для загрузки: {STORAGE_BACKEND}")
+    return _storage
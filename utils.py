@@ -1,61 +1,206 @@
+import io
 import os
 import time
 import logging
 import shutil
-import aiofiles
+import struct
 import asyncio
 import random
+import subprocess
+import threading
 from PIL import Image, ImageOps
-from PIL.ExifTags import TAGS
+from aiogram.exceptions import (TelegramBadRequest,
+                                TelegramForbiddenError,
+                                TelegramUnauthorizedError,
+                                TelegramNotFound,
+                                TelegramConflictError,
+                                TelegramMigrateToChat,
+                                TelegramEntityTooLarge
+                            )
 from watchdog.events import FileSystemEventHandler
 from moviepy.editor import ImageClip, concatenate_videoclips, AudioFileClip, vfx
+from moviepy.config import get_setting
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from metrics import timer, PHOTOS, UPLOADED_BYTES
+from logs import bind_log_context
+
 
 load_dotenv()
 
 
 API_TOKEN = os.getenv('BOT_TOKEN')
-TOKEN = os.getenv("YANDEX")
-
 
-def create_videos(photo_dir: str, audio_dir: str) -> str | None:
-    """Функция для создания слайдшоу с наложением музыки. 
-    Принимает путь к директории с фото и путь к директории с аудио файлами"""
+# Ограничение Telegram на размер файла, отправляемого ботом (МБ)
+TELEGRAM_FILE_LIMIT_MB = 50
+# Длительность показа одного фото в слайдшоу (сек)
+PHOTO_DURATION = 0.5
+# Частота кадров слайдшоу: фото статичны, поэтому достаточно нескольких повторяющихся кадров
+SLIDESHOW_FPS = int(os.getenv('SLIDESHOW_FPS', 4))
+AUDIO_BITRATE_KBPS = 128
+# Теги EXIF: вспышка и ссылка на Exif IFD
+EXIF_FLASH_TAG = 0x9209
+EXIF_IFD_POINTER = 0x8769
+EXIF_ORIENTATION_TAG = 0x0112
+# Фото без тега Flash принимаются (раньше фото с EXIF, но без этого тега отбрасывались);
+# с DARK_CHECK=1 из них отбрасываются темные. Порог средней яркости (0-255)
+DARK_CHECK = os.getenv('DARK_CHECK', '0') == '1'
+DARK_THRESHOLD = int(os.getenv('DARK_THRESHOLD', 20))
+# Повтор запросов к внешним сервисам: попытки, задержки и общий срок (сек)
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', 5))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 30))
+RETRY_DEADLINE = float(os.getenv('RETRY_DEADLINE', 60))
+# Размыкатель: ошибок подряд до приостановки вызовов и длительность паузы (сек)
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', 5))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 30))
+# Количество одновременных загрузок в облачное хранилище
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', 4))
+VIDEO_CRF = 23
+# Качество JPEG уменьшенных копий для слайдшоу
+RESIZE_QUALITY = int(os.getenv('RESIZE_QUALITY', 90))
+# Прием фото с камеры: количество потоков, интервал проверки окончания записи и предельное ожидание (сек)
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 4))
+STABLE_INTERVAL = float(os.getenv('STABLE_INTERVAL', 0.2))
+STABLE_TIMEOUT = float(os.getenv('STABLE_TIMEOUT', 30))
+# Способ сборки слайдшоу: ffmpeg (concat demuxer, без покадровой обработки в Python) или moviepy
+SLIDESHOW_RENDERER = os.getenv('SLIDESHOW_RENDERER', 'ffmpeg')
+# Путь к ffmpeg, который использует moviepy
+FFMPEG_BINARY = get_setting("FFMPEG_BINARY")
+
+_ingest_pool = None
+
+
+def video_maxrate(duration: float, limit_mb: float = TELEGRAM_FILE_LIMIT_MB) -> int:
+    """Максимальный битрейт видео (кбит/с), при котором ролик длительностью duration
+    гарантированно помещается в limit_mb. При bufsize равном maxrate видеопоток
+    не превышает maxrate * (duration + 1)"""
+    budget_kbits = limit_mb * 1024 * 1024 * 8 / 1000 * 0.97 - AUDIO_BITRATE_KBPS * duration
+    return max(100, int(budget_kbits / (duration + 1)))
+
+
+def x264_params(maxrate: int) -> list:
+    """Параметры однопроходного кодирования: постоянное качество с ограничением битрейта"""
+    return ['-crf', str(VIDEO_CRF), '-maxrate', f'{maxrate}k', '-bufsize', f'{maxrate}k']
+
+
+def choose_audio(audio_dir: str) -> str | None:
+    """Выбирает случайный mp3 трек из директории"""
     try:
         # Создаем список треков и выбираем случайный
         audios = [f for f in os.listdir(audio_dir) if f.lower().endswith('.mp3')]
         if not audios:
-            logging.error("[create_videos] Нет доступных аудио файлов.")
+            logging.error("[choose_audio] Нет доступных аудио файлов.")
             return None
 
         audio_file = os.path.join(audio_dir, random.choice(audios))
-        logging.info(f"[create_videos] Выбран аудиофайл: {audio_file}")
+        logging.info(f"[choose_audio] Выбран аудиофайл: {audio_file}")
+        return audio_file
 
     except Exception as e:
-        logging.exception(f"[create_videos] Ошибка при поиске аудио: {e}")
+        logging.exception(f"[choose_audio] Ошибка при поиске аудио: {e}")
+        return None
+
+
+
+def create_videos(photo_dir: str, audio_dir: str, output_path: str | None = None,
+                  renderer: str | None = None) -> str | None:
+    """Функция для создания слайдшоу с наложением музыки. 
+    Принимает путь к директории с фото и путь к директории с аудио файлами.
+    По умолчанию видео сохраняется в директорию с фото"""
+    audio_file = choose_audio(audio_dir)
+    if not audio_file:
+        return None
+
+    output_path = output_path or os.path.join(photo_dir, 'slideshow.mp4')
+
+    if (renderer or SLIDESHOW_RENDERER) == 'ffmpeg':
+        video_path = create_videos_ffmpeg(photo_dir, audio_file, output_path)
+        if video_path:
+            return video_path
+        logging.warning("[create_videos] Не удалось собрать слайдшоу через ffmpeg, используется moviepy")
+
+    return create_videos_moviepy(photo_dir, audio_file, output_path)
+
+
+
+def create_videos_ffmpeg(photo_dir: str, audio_file: str, output_path: str) -> str | None:
+    """Сборка слайдшоу напрямую в ffmpeg: список фото с длительностями
+    для concat demuxer и зацикленный звук"""
+    photos = sorted(f for f in os.listdir(photo_dir) if f.lower().endswith('.jpg'))
+    if not photos:
+        logging.error("[create_videos_ffmpeg] Нет доступных фотографий для слайдшоу.")
         return None
 
+    duration = len(photos) * PHOTO_DURATION
+    maxrate = video_maxrate(duration)
+    list_path = os.path.join(photo_dir, 'slideshow.txt')
+
+    # Последний файл повторяется, иначе concat demuxer не учитывает его длительность
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for filename in photos + photos[-1:]:
+            file_path = os.path.abspath(os.path.join(photo_dir, filename)).replace('\\', '/').replace("'", "'\\''")
+            f.write(f"file '{file_path}'\nduration {PHOTO_DURATION}\n")
+
+    # Фото по центру черного фона 1920x1080, как при concatenate_videoclips(method='compose')
+    video_filter = ('scale=1920:1080:force_original_aspect_ratio=decrease,'
+                    'pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1,'
+                    f'fps={SLIDESHOW_FPS},format=yuv420p')
+    command = [
+        FFMPEG_BINARY, '-y', '-loglevel', 'error',
+        '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-stream_loop', '-1', '-i', audio_file,
+        '-map', '0:v', '-map', '1:a',
+        '-vf', video_filter,
+        '-c:v', 'libx264', '-preset', 'veryfast', *x264_params(maxrate), '-threads', '2',
+        '-c:a', 'aac', '-b:a', f'{AUDIO_BITRATE_KBPS}k',
+        '-t', str(duration),
+        output_path
+    ]
+
+    try:
+        subprocess.run(command, check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"[create_videos_ffmpeg] Ошибка ffmpeg: {e.stderr.decode(errors='ignore')}")
+        return None
+    finally:
+        os.remove(list_path)
+
+    # Чистим папку слайдшоу
+    for photo in photos:
+        os.remove(os.path.join(photo_dir, photo))
+
+    file_size = os.path.getsize(output_path) / (1024 * 1024)
+    logging.info(f"[create_videos_ffmpeg] Слайдшоу из {len(photos)} фото, размер видео: {file_size:.2f} МБ")
+    return output_path
+
+
+
+def create_videos_moviepy(photo_dir: str, audio_file: str, output_path: str) -> str | None:
+    """Сборка слайдшоу через moviepy (запасной вариант)"""
+
     try:
         # Создаем список фотографий
         photos = [f for f in os.listdir(photo_dir) if f.lower().endswith('.jpg')]
         if not photos:
-            logging.error("[create_videos] Нет доступных фотографий для слайдшоу.")
+            logging.error("[create_videos_moviepy] Нет доступных фотографий для слайдшоу.")
             return None
         
         # Создаем ImageClip после корректировки ориентации и размера 
         clips = [
-            ImageClip(os.path.join(photo_dir, filename)).set_duration(0.5)
+            ImageClip(os.path.join(photo_dir, filename)).set_duration(PHOTO_DURATION)
             for filename in photos
         ]
 
         if not clips:
-            logging.error("[create_videos] Не удалось создать клипы из фотографий.")
+            logging.error("[create_videos_moviepy] Не удалось создать клипы из фотографий.")
             return None
 
     except Exception as e:
-        logging.exception(f"[create_videos] Ошибка при подготовке фотографий: {e}")
+        logging.exception(f"[create_videos_moviepy] Ошибка при подготовке фотографий: {e}")
         return None
     
     # Чистим папку слайдшоу
@@ -74,121 +219,394 @@ def create_videos(photo_dir: str, audio_dir: str) -> str | None:
 
         final_clip = final_clip.set_audio(audio)
 
-        # Генерируем временный уникальный файл
-        temp_video_path = os.path.join(r'C:\slideshow', 'slideshow.mp4')
+        temp_video_path = output_path
+
+        # Битрейт рассчитывается заранее по длительности, чтобы уложиться в лимит Telegram за один проход
+        maxrate = video_maxrate(final_clip.duration)
+        logging.info(f"[create_videos_moviepy] Длительность {final_clip.duration:.1f} сек, maxrate {maxrate}k")
 
         # Сохранение итогового видео
         final_clip.write_videofile(
             temp_video_path,
-            fps=30,
+            fps=SLIDESHOW_FPS,
             codec='libx264',
             audio_codec='aac',
+            audio_bitrate=f'{AUDIO_BITRATE_KBPS}k',
+            ffmpeg_params=x264_params(maxrate),
             threads=2
         )
         final_clip.close()
 
         # Проверка размера файла
         file_size = os.path.getsize(temp_video_path) / (1024 * 1024)
-        logging.info(f"[create_videos] Размер видео: {file_size:.2f} МБ")
-
-        # Если размер больше 50 МБ, уменьшаем качество и сохраняем снова
-        if file_size > 50:
-            logging.info("Файл больше 50 МБ, сжимаем...")
-            compressed_path = temp_video_path.replace('.mp4', '_compressed.mp4')
-
-            final_clip.write_videofile(
-                compressed_path,
-                fps=30,
-                codec='libx264',
-                audio_codec='aac',
-                bitrate="500k"
-            )
-
-            os.remove(temp_video_path)  # Удаляем большой файл
-
-            temp_video_path = compressed_path  # Переопределяем финальный путь!
-            logging.info(f"[create_videos] Сжатое видео: {compressed_path}")        
+        logging.info(f"[create_videos_moviepy] Размер видео: {file_size:.2f} МБ")
 
         return temp_video_path
 
     except Exception as e:
-        logging.exception(f"[create_videos] Ошибка при создании или сохранении видео: {e}")
+        logging.exception(f"[create_videos_moviepy] Ошибка при создании или сохранении видео: {e}")
         return None
 
 
 
-def resize_photo(image_path: str, save_dir: str, max_width=1920, max_height=1080):    
-    try:        
+def resize_photo(image_path: str, save_dir: str, max_width=1920, max_height=1080) -> str | None:
+    try:
         with Image.open(image_path) as img:
+            # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8), не меньше нужного размера.
+            # Для повернутых фото (EXIF Orientation 5-8) ширина и высота в файле поменяны местами
+            if img.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+                img.draft('RGB', (max_height, max_width))
+            else:
+                img.draft('RGB', (max_width, max_height))
+
             # Автоматическая корректировка ориентации
             image = ImageOps.exif_transpose(img)
-           
+
             # Изменяем размер изображения, если оно превышает максимальное разрешение
             image.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
 
             # Сохраняем исправленное изображение
-            save_path = os.path.join(save_dir, image_path.split('\\')[-1])
-            image.save(save_path, format='JPEG')
+            save_path = os.path.join(save_dir, os.path.basename(image_path))
+            image.convert('RGB').save(save_path, format='JPEG', quality=RESIZE_QUALITY, optimize=True)
+            return save_path
 
     except Exception as e:
         logging.error(f"Ошибка при обработке resize_photo {image_path}: {e}")
+        return None
 
 
 
+# Чтение значения тега Flash из TIFF-структуры EXIF
+def _parse_exif_flash(tiff: bytes) -> int | None:
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+
+    def read_ifd(offset):
+        count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+        for i in range(count):
+            entry = offset + 2 + i * 12
+            tag, value_type = struct.unpack_from(endian + 'HH', tiff, entry)
+            # SHORT хранится в первых двух байтах поля значения, LONG - во всех четырех
+            if value_type == 3:
+                yield tag, struct.unpack_from(endian + 'H', tiff, entry + 8)[0]
+            elif value_type == 4:
+                yield tag, struct.unpack_from(endian + 'I', tiff, entry + 8)[0]
+
+    ifd0 = struct.unpack_from(endian + 'I', tiff, 4)[0]
+    exif_ifd = None
+    for tag, value in read_ifd(ifd0):
+        if tag == EXIF_FLASH_TAG:
+            return value
+        if tag == EXIF_IFD_POINTER:
+            exif_ifd = value
+
+    if exif_ifd is not None:
+        for tag, value in read_ifd(exif_ifd):
+            if tag == EXIF_FLASH_TAG:
+                return value
+    return None
+
+
+# Значение тега Flash из сегмента APP1 файла JPEG, без декодирования изображения.
+# None, если файл не JPEG, EXIF нет или в нем нет тега Flash
+def read_exif_flash(image_path: str) -> int | None:
+    with open(image_path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            # Байты-заполнители 0xFF перед маркером
+            while marker[1] == 0xFF:
+                marker = marker[1:] + f.read(1)
+            # Начало данных изображения или конец файла - EXIF уже не встретится
+            if marker[1] in (0xD9, 0xDA):
+                return None
+            length = struct.unpack('>H', f.read(2))[0]
+            if marker[1] == 0xE1:
+                segment = f.read(length - 2)
+                if segment[:6] == b'Exif\x00\x00':
+                    return _parse_exif_flash(segment[6:])
+            else:
+                f.seek(length - 2, 1)
+
+
+# Проверка яркости по уменьшенной копии: JPEG декодируется сразу в 1/8 размера
+def is_dark_photo(image_path: str, threshold: int = DARK_THRESHOLD) -> bool:
+    with Image.open(image_path) as img:
+        img.draft('L', (160, 120))
+        gray = img.convert('L')
+    gray.thumbnail((160, 120))
+    histogram = gray.histogram()
+    mean = sum(i * count for i, count in enumerate(histogram)) / max(sum(histogram), 1)
+    return mean < threshold
+
+
 # Функция для обнаружения темных фотографий
 def check_photo(image_path: str) -> bool:
     try:
-        img = Image.open(image_path)
-        exif_data = img._getexif()
-        
-        if not exif_data:            
-            logging.warning(f"Нет метаданных у фото {image_path}")
-            return True  # Нет EXIF-данных
-
-        for tag, value in exif_data.items():            
-            tag_name = TAGS.get(tag, tag)            
-            if tag_name == "Flash":
-                # logging.info(f"Параметры вспышки {tag_name} - {value}")
-                if value == 9:
-                    return True # Означает, что вспышка была 
-                else:
-                    return False 
-            
+        flash = read_exif_flash(image_path)
+        if flash is not None:
+            return flash == 9  # Означает, что вспышка была
+
+        logging.warning(f"Нет данных о вспышке у фото {image_path}")
+        if DARK_CHECK:
+            return not is_dark_photo(image_path)
+        return True
+
     except Exception as e:
         logging.error(f"Ошибка обработки в check_photo {image_path}: {e}")
         return True
-        
 
 
-# Функция для повторной попытки выполнения
-async def retry_on_failure(func, *args, **kwargs):
-    retries = 5
-    delay = 2
-    for attempt in range(retries):
-        try:
-            return await func(*args, **kwargs)
-        except Exception as e:
-            logging.error(f"Ошибка: {e}. новая попытка {delay} секунд...")
-            await asyncio.sleep(delay)
-            delay *= 2  # Увеличиваем задержку экспоненциально
-    logging.error(f"Максимальное количество попыток {func}.")
-    raise Exception("Максимальное количество попыток")
 
+class CircuitOpenError(Exception):
+    """Сервис недоступен: вызов отклонен без обращения к нему"""
 
 
-def convert_photo(file, file_id):
-    # Открываем изображение и автоматически исправляем ориентацию
-    image = ImageOps.exif_transpose(Image.open(file))
+class CircuitBreaker:
+    """Размыкатель для одного сервиса: после threshold неудачных попыток подряд вызовы
+    сразу отклоняются на cooldown секунд, затем пропускается один пробный вызов"""
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
 
-    # Преобразуем изображение в черно-белое
-    bw_image = image.convert('L')
-    
-    # Сохраняем черно-белое изображение во временный файл с высоким качеством
-    bw_image_path = f"bw_{file_id}.jpg"
-    bw_image.save(bw_image_path, quality=95)
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.cooldown or self.probing:
+            return False
+        self.probing = True
+        return True
 
-    return bw_image_path
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info(f"[CircuitBreaker] {self.name} снова доступен")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            logging.error(f"[CircuitBreaker] {self.name}: {self.failures} ошибок подряд, "
+                          f"вызовы приостановлены на {self.cooldown} секунд")
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+# Ошибки, которые не исправятся повтором запроса
+NON_RETRYABLE_ERRORS = (TelegramBadRequest,
+                        TelegramForbiddenError,
+                        TelegramUnauthorizedError,
+                        TelegramNotFound,
+                        TelegramConflictError,
+                        TelegramMigrateToChat,
+                        TelegramEntityTooLarge,
+                        FileNotFoundError,
+                        CircuitOpenError)
+
+
+class RetryPolicy:
+    """Повтор вызовов внешних сервисов: экспоненциальная задержка со случайным разбросом,
+    ожидание retry_after от сервера, общий срок deadline и размыкатель на каждый метод
+    (общий для всех сессий). Ошибки 4xx, кроме 408 и 429, не повторяются"""
+    def __init__(self, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 deadline=RETRY_DEADLINE):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breakers = {}
+
+    # Метод сервиса, например Bot.send_document или YandexDiskStorage.upload_stream
+    def breaker(self, func) -> CircuitBreaker:
+        name = getattr(func, '__qualname__', repr(func))
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(name)
+        return self.breakers[name]
+
+    @staticmethod
+    def is_retryable(error) -> bool:
+        if isinstance(error, NON_RETRYABLE_ERRORS):
+            return False
+        status = getattr(error, 'status', None)
+        if isinstance(status, int) and 400 <= status < 500:
+            return status in (408, 429)
+        return True
+
+    # Задержка, которую запросил сервер (TelegramRetryAfter, заголовок Retry-After)
+    @staticmethod
+    def retry_after(error) -> float | None:
+        value = getattr(error, 'retry_after', None)
+        if value is None:
+            headers = getattr(error, 'headers', None) or {}
+            value = headers.get('Retry-After')
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
 
+    def delay(self, attempt, error) -> float:
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            # Небольшой разброс, чтобы все ожидающие сессии не повторили запрос одновременно
+            return retry_after * random.uniform(1, 1.2)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def run(self, func, *args, **kwargs):
+        breaker = self.breaker(func)
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(f"{breaker.name} временно недоступен")
+            # Пробный вызов после паузы размыкателя
+            probe = breaker.probing
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    breaker.record_success()
+                    logging.error(f"[retry] {breaker.name}: {e}. Повтор не поможет")
+                    raise
+                # Ограничение частоты - сервис работает: размыкатель не срабатывает, а пробный вызов его замыкает
+                if self.retry_after(e) is None:
+                    breaker.record_failure()
+                elif probe:
+                    breaker.record_success()
+                delay = self.delay(attempt, e)
+                if attempt == self.attempts - 1 or time.monotonic() + delay > deadline:
+                    logging.error(f"[retry] {breaker.name}: {e}. Попытки исчерпаны ({attempt + 1})")
+                    raise
+                logging.error(f"[retry] {breaker.name}: {e}. Новая попытка через {delay:.1f} секунд...")
+                await asyncio.sleep(delay)
+            else:
+                breaker.record_success()
+                return result
+            finally:
+                # Отмененный пробный вызов не должен оставить размыкатель открытым навсегда
+                if probe:
+                    breaker.probing = False
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+# Функция для повторной попытки выполнения
+async def retry_on_failure(func, *args, **kwargs):
+    return await DEFAULT_RETRY_POLICY.run(func, *args, **kwargs)
+
+
+class RateLimiter:
+    """Ограничение частоты запросов по алгоритму token bucket:
+    rate запросов в секунду в среднем, не более capacity подряд"""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+
+def convert_photo(file) -> bytes:
+    # Открываем изображение (путь или файловый объект) и автоматически исправляем ориентацию
+    with Image.open(file) as img:
+        image = ImageOps.exif_transpose(img)
+
+        # Преобразуем изображение в черно-белое
+        bw_image = image.convert('L')
+
+    # Кодируем черно-белое изображение в память с высоким качеством
+    buffer = io.BytesIO()
+    bw_image.save(buffer, format='JPEG', quality=95)
+
+    return buffer.getvalue()
+
+
+
+class FileCache:
+    """Небольшой кеш файлов на диске: при переполнении удаляются давно не использованные.
+    Файлы хранятся в собственной подпапке кеша внутри folder. put копирует файл,
+    поэтому вызывается в пуле потоков; список файлов защищен блокировкой"""
+    subfolder = 'file_cache'
+
+    def __init__(self, folder, max_files):
+        self.folder = os.path.join(folder, self.subfolder)
+        self.max_files = max_files
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Удаление файлов, оставшихся от предыдущего запуска: кешу они неизвестны
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+        if os.path.isdir(self.folder):
+            for filename in os.listdir(self.folder):
+                file_path = os.path.join(self.folder, filename)
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+
+    def put(self, key, src_path):
+        os.makedirs(self.folder, exist_ok=True)
+        cache_path = os.path.join(self.folder, key + os.path.splitext(src_path)[1])
+        try:
+            # Жесткая ссылка не копирует данные, если папки на одном диске
+            os.link(src_path, cache_path)
+        except OSError:
+            shutil.copyfile(src_path, cache_path)
+        with self.lock:
+            self.files[key] = cache_path
+            evicted = []
+            while len(self.files) > self.max_files:
+                evicted.append(self.files.popitem(last=False)[1])
+        for old_path in evicted:
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def get(self, key):
+        with self.lock:
+            cache_path = self.files.get(key)
+            if cache_path is None:
+                return None
+            self.files.move_to_end(key)
+        return cache_path if os.path.exists(cache_path) else None
+
+
+
+# Общий пул потоков приема фото для всех сессий
+def get_ingest_pool():
+    global _ingest_pool
+    if _ingest_pool is None:
+        _ingest_pool = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+    return _ingest_pool
+
+
+def shutdown_ingest_pool():
+    global _ingest_pool
+    if _ingest_pool is not None:
+        _ingest_pool.shutdown(wait=False, cancel_futures=True)
+        _ingest_pool = None
 
 
 # Преобразование номера телефона
@@ -202,100 +620,191 @@ def normalize_phone_number(phone_number):
 
 
 class PhotoHandler(FileSystemEventHandler):
-    def __init__(self,  phone_number, clients_folder):
+    """Принимает новые фото камеры. Поток watchdog только ставит файл в очередь,
+    ожидание окончания записи, проверка и перемещение выполняются в потоках INGEST_WORKERS"""
+    def __init__(self,  phone_number, clients_folder, loop=None, queue=None,
+                 stable_interval=STABLE_INTERVAL, stable_timeout=STABLE_TIMEOUT, stats=None, session_id=None):
+        self.phone_number = phone_number
+        self.session_id = session_id
         self.folder = os.path.join(clients_folder, phone_number)
         self.last_modified = datetime.now()
-        
-   
-    def on_created(self, event):        
-        if not event.is_directory:                             
+        # Очередь сессии, в которую передаются принятые фото (из потока watchdog)
+        self.loop = loop
+        self.queue = queue
+        # Сводка метрик сессии (metrics.SessionStats)
+        self.stats = stats
+        self.stable_interval = stable_interval
+        self.stable_timeout = stable_timeout
+        # Файлы в обработке: путь -> событие закрытия файла после записи
+        self.pending = {}
+        self.lock = threading.Lock()
+
+
+    def on_created(self, event):
+        if not event.is_directory:
             if event.src_path.lower().endswith(('.jpg', '.jpeg', '.png')):
-                time.sleep(1)
-                if check_photo(event.src_path):
-                    self.move_file_with_retry(event.src_path, self.folder)
-                    self.last_modified = datetime.now()           
-                else:
-                    os.remove(event.src_path)    
+                self.enqueue(event.src_path)
 
 
-    def on_moved(self, event):        
-        if not event.is_directory:            
+    def on_moved(self, event):
+        if not event.is_directory:
             if event.dest_path.lower().endswith(('.jpg', '.jpeg', '.png')):
-                if check_photo(event.dest_path):           
-                    self.move_file_with_retry(event.dest_path, self.folder)
-                    self.last_modified = datetime.now()
-                else:
-                    os.remove(event.dest_path)    
-                    
+                self.enqueue(event.dest_path)
 
+
+    # IN_CLOSE_WRITE в Linux: камера закончила запись, ждать стабилизации размера не нужно
+    def on_closed(self, event):
+        with self.lock:
+            closed = self.pending.get(event.src_path)
+        if closed is not None:
+            closed.set()
+
+
+    def enqueue(self, src):
+        with self.lock:
+            if src in self.pending:
+                return
+            self.pending[src] = threading.Event()
+        get_ingest_pool().submit(self.process, src)
+
+
+    def process(self, src):
+        bind_log_context(session=self.session_id, phone=self.phone_number)
+        try:
+            with timer('wait_written', self.stats):
+                written = self.wait_until_written(src)
+            if written:
+                self.accept_photo(src)
+        except Exception as e:
+            logging.exception(f"[PhotoHandler] Ошибка при обработке {src}: {e}")
+        finally:
+            with self.lock:
+                self.pending.pop(src, None)
+
+
+    # Ожидание окончания записи: событие закрытия файла или неизменные размер и mtime
+    # между двумя проверками. False, если файл исчез
+    def wait_until_written(self, src) -> bool:
+        closed = self.pending[src]
+        deadline = time.monotonic() + self.stable_timeout
+        last = None
+        while True:
+            try:
+                stat = os.stat(src)
+            except FileNotFoundError:
+                return False
+            current = (stat.st_size, stat.st_mtime_ns)
+            if closed.is_set() or (current == last and stat.st_size > 0):
+                return True
+            if time.monotonic() >= deadline:
+                logging.warning(f"[PhotoHandler] Файл {src} не перестал меняться за {self.stable_timeout} с")
+                return True
+            last = current
+            closed.wait(self.stable_interval)
+
+
+    def accept_photo(self, src):
+        with timer('check_photo', self.stats):
+            accepted = check_photo(src)
+        if accepted:
+            PHOTOS.inc('accepted')
+            with timer('move', self.stats):
+                dst = self.move_file_with_retry(src, self.folder)
+            self.last_modified = datetime.now()
+            if dst and self.queue is not None:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, dst)
+        else:
+            PHOTOS.inc('rejected')
+            os.remove(src)
+
+
+    # Файл может быть еще открыт камерой или антивирусом: повторяем в потоке обработки,
+    # не задерживая поток watchdog и остальные фото
     def move_file_with_retry(self, src, dst_folder, retries=5, delay=1):
         dst = os.path.join(dst_folder, os.path.basename(src))
-        for _ in range(retries):
+        for attempt in range(retries):
             try:
                 shutil.move(src, dst)
-                break
+                return dst
             except PermissionError:
-                time.sleep(delay)
-        else:
-            logging.error(f"Не удалось переместить файл {src} в {dst} после {retries} попыток")
-
-
-# Функция для создания папки и получения ссылки на яндекс диске
-async def create_and_publish_folder(session, disk_path):
-    encoded_disk_path = disk_path.replace("+", "%2B")
-    url = f"https://cloud-api.yandex.net/v1/disk/resources?path={encoded_disk_path}"
-    headers = {"Authorization": f"OAuth {TOKEN}"}
-    public_url = None
-
-    # Создание папки
-    async with session.put(url, headers=headers) as resp:                  
-        if resp.status == 201:
-            logging.info(f"Папка {disk_path} создана.")
-        elif resp.status == 409:
-            logging.info(f"Папка {disk_path} уже существует.")
-        else:
-            error = await resp.json()
-            logging.error(f"Ошибка при создании папки на Яндекс.Диске: {error}")
-            return public_url
-    
-    # Сделать папку публичной
-    url = f"https://cloud-api.yandex.net/v1/disk/resources/publish?path={encoded_disk_path}"
-    async with session.put(url, headers=headers) as resp:
-        if resp.status == 200:
-            logging.info(f"Папка {encoded_disk_path} теперь публичная.")
-
-            # Получение публичной ссылки
-            url = f"https://cloud-api.yandex.net/v1/disk/resources?path={encoded_disk_path}"
-            async with session.get(url, headers=headers) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    public_url = data.get('public_url')            
-                else:
-                    error = await resp.json()
-                    logging.error(f"Ошибка при получении информации о ресурсе на Яндекс.Диске: {error}")
-        else:
-            error = await resp.json()
-            logging.error(f"Ошибка при открытии доступа к папке на Яндекс.Диске: {error}")
-
-    return public_url 
-
-
-# Функция для загрузки файлов на яндекс диск
-async def upload_file(session, file_path, yandex_disk_path):
-    encoded_yandex_disk_path = yandex_disk_path.replace("+", "%2B")
-    url = f"https://cloud-api.yandex.net/v1/disk/resources/upload?path={encoded_yandex_disk_path}"
-    headers = {"Authorization": f"OAuth {TOKEN}"}
-    async with session.get(url, headers=headers) as resp:
-        if resp.status == 200:
-            upload_url = (await resp.json())['href']
-            async with aiofiles.open(file_path, 'rb') as f:
-                async with session.put(upload_url, data=await f.read()) as upload_resp:
-                    if upload_resp.status == 201:
-                        logging.info(f"Файл {file_path} успешно загружен на Яндекс.Диск.")
-                    else:
-                        error = await upload_resp.json()
-                        logging.error(f"Ошибка при загрузке файла на Яндекс.Диск: {error}")
-        else:
-            error = await resp.json()
-            logging.error(f"Ошибка при получении ссылки загрузки на Яндекс.Диск: {error}")
-            
\ No newline at end of file
+                if attempt < retries - 1:
+                    time.sleep(delay)
+        logging.error(f"Не удалось переместить файл {src} в {dst} после {retries} попыток")
+        return None
+
+
+class UploadPipeline:
+    """Параллельная загрузка файлов в папку облачного хранилища (storage.Storage).
+    Ссылки для следующих файлов запрашиваются, пока идет загрузка текущих;
+    одновременно выполняется не более concurrency загрузок"""
+    def __init__(self, session, storage, folder, concurrency=UPLOAD_CONCURRENCY):
+        self.session = session
+        self.storage = storage
+        self.folder = folder
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # Ограничение очереди, чтобы не запрашивать ссылки слишком далеко вперед
+        self.slots = asyncio.Semaphore(concurrency * 2)
+        self.tasks = set()
+        self.files = 0
+        self.failed = 0
+        self.bytes = 0
+        # Время, когда шла хотя бы одна загрузка (без ожидания новых фото)
+        self.active = 0
+        self.busy_since = 0.0
+        self.busy_time = 0.0
+
+    # Постановка файла в очередь; ждет, если очередь заполнена.
+    # on_done(file_path, success) вызывается после завершения загрузки
+    async def submit(self, file_path, on_done=None):
+        await self.slots.acquire()
+        task = asyncio.create_task(self._upload(file_path, on_done))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _upload(self, file_path, on_done):
+        success = False
+        try:
+            with timer('upload_url'):
+                upload_url = await retry_on_failure(self.storage.get_upload_url, self.session,
+                                                    self.folder, os.path.basename(file_path))
+            async with self.semaphore:
+                size = os.path.getsize(file_path)
+                started = time.perf_counter()
+                if self.active == 0:
+                    self.busy_since = started
+                self.active += 1
+                try:
+                    with timer('upload'):
+                        await retry_on_failure(self.storage.upload_stream, self.session, upload_url, file_path)
+                finally:
+                    self.active -= 1
+                    if self.active == 0:
+                        self.busy_time += time.perf_counter() - self.busy_since
+                elapsed = time.perf_counter() - started
+            self.files += 1
+            self.bytes += size
+            UPLOADED_BYTES.inc(amount=size)
+            success = True
+            logging.info(f"[UploadPipeline] {os.path.basename(file_path)}: {size / 1024 / 1024:.2f} МБ "
+                         f"за {elapsed:.2f} сек ({size / 1024 / 1024 / max(elapsed, 1e-6):.2f} МБ/с)",
+                         extra={'stage': 'upload', 'duration': elapsed})
+        except Exception as e:
+            self.failed += 1
+            logging.error(f"[UploadPipeline] Ошибка при загрузке {file_path}: {e}")
+        finally:
+            self.slots.release()
+            if on_done:
+                try:
+                    await on_done(file_path, success)
+                except Exception as e:
+                    logging.error(f"[UploadPipeline] Ошибка обработки {file_path} после загрузки: {e}")
+
+    # Ожидание завершения всех загрузок и итоговая скорость
+    async def join(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.files:
+            logging.info(f"[UploadPipeline] Загружено {self.files} файлов ({self.bytes / 1024 / 1024:.2f} МБ) "
+                         f"за {self.busy_time:.2f} сек загрузки, "
+                         f"{self.bytes / 1024 / 1024 / max(self.busy_time, 1e-6):.2f} МБ/с. "
+                         f"Ошибок: {self.failed}")
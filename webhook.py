@@ -0,0 +1,51 @@
+import os
+import re
+import asyncio
+import logging
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+
+# Получение обновлений: polling - long polling (getUpdates), webhook - Telegram отправляет их на наш сервер
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Адрес и путь, на которых слушает сервер webhook (обычно за reverse proxy с HTTPS)
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token; запросы без него отклоняются.
+# Обязателен: без проверки любой, кто знает адрес, может прислать поддельные обновления
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Внешний адрес (https://bot.example.com), на который Telegram отправляет обновления.
+# Если не задан, webhook не регистрируется - например, его уже зарегистрировал другой экземпляр бота
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+
+
+async def run_webhook(dp, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                      secret=WEBHOOK_SECRET, public_url=WEBHOOK_URL):
+    """Сервер webhook: каждое обновление обрабатывается в отдельной задаче,
+    Telegram сразу получает ответ 200 и не ждет окончания доставки фото"""
+    # Допустимые символы и длина секрета - по требованиям Bot API к secret_token
+    if not secret or not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', secret):
+        raise RuntimeError("Для режима webhook задайте WEBHOOK_SECRET: 1-256 символов A-Z, a-z, 0-9, _ и -")
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    # Startup и shutdown диспетчера, закрытие сессии бота при остановке сервера
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        if public_url:
+            await bot.set_webhook(f"{public_url.rstrip('/')}{path}", secret_token=secret,
+                                  allowed_updates=dp.resolve_used_update_types())
+        logging.info(f"[webhook] Прием обновлений на http://{host}:{port}{path}"
+                     + (f", webhook {public_url.rstrip('/')}{path}" if public_url else ""))
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
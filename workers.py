@@ -0,0 +1,97 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from utils import resize_photo, convert_photo, create_videos
+from metrics import timer, timed
+from profiling import PROFILING, slow_call
+from logs import get_worker_log_queue, setup_worker_logging
+
+
+load_dotenv()
+
+
+# Количество процессов для тяжелой обработки (видео, ресайз)
+PROCESS_WORKERS = int(os.getenv('PROCESS_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+# Количество потоков для легких блокирующих операций (EXIF, Ч/Б)
+THREAD_WORKERS = int(os.getenv('THREAD_WORKERS', 4))
+# Максимальное количество одновременно создаваемых слайдшоу
+MAX_RENDERS = int(os.getenv('MAX_RENDERS', 1))
+
+_process_pool = None
+_thread_pool = None
+_render_semaphore = None
+
+
+# Записи дочерних процессов передаются через очередь в основной процесс
+def _init_worker(log_queue):
+    setup_worker_logging(log_queue)
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS, initializer=_init_worker,
+                                            initargs=(get_worker_log_queue(),))
+    return _process_pool
+
+
+def get_thread_pool():
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=THREAD_WORKERS, thread_name_prefix='worker')
+    return _thread_pool
+
+
+async def run_in_process(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if not PROFILING:
+        return await loop.run_in_executor(get_process_pool(), call)
+    async with slow_call(f"Процесс {func.__qualname__}"):
+        return await loop.run_in_executor(get_process_pool(), call)
+
+
+async def run_in_thread(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if not PROFILING:
+        return await loop.run_in_executor(get_thread_pool(), call)
+    # Для потока в лог попадает стек самого потока в момент превышения порога
+    watch = slow_call(f"Поток {func.__qualname__}")
+    async with watch:
+        return await loop.run_in_executor(get_thread_pool(), watch.bind(call))
+
+
+# Асинхронные обертки над функциями utils.py
+@timed('resize_photo')
+async def resize_photo_async(image_path: str, save_dir: str, max_width=1920, max_height=1080):
+    return await run_in_process(resize_photo, image_path, save_dir, max_width, max_height)
+
+
+@timed('convert_photo')
+async def convert_photo_async(file) -> bytes:
+    return await run_in_thread(convert_photo, file)
+
+
+async def create_videos_async(photo_dir: str, audio_dir: str, output_path: str | None = None) -> str | None:
+    global _render_semaphore
+    if _render_semaphore is None:
+        _render_semaphore = asyncio.Semaphore(MAX_RENDERS)
+
+    # Ограничиваем количество одновременных рендеров, остальные ждут в очереди
+    async with _render_semaphore:
+        with timer('create_videos'):
+            return await run_in_process(create_videos, photo_dir, audio_dir, output_path)
+
+
+def shutdown():
+    global _process_pool, _thread_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
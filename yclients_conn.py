@@ -1,8 +1,21 @@
+import time
 import httpx
+import asyncio
 import logging
 import os
 from dotenv import load_dotenv
 
+from database import (add_client_phones,
+                      replace_client_phones,
+                      is_client_phone,
+                      get_max_client_id,
+                      get_sync_value,
+                      set_sync_value,
+                      run_db
+                    )
+from utils import normalize_phone_number
+from metrics import timed
+
 load_dotenv()
 
 
@@ -12,61 +25,219 @@ CID = os.getenv('COMPANY_ID')
 PID = os.getenv('PARTNER_ID')
 USER_TOKEN = os.getenv('USER_TOKEN')
 
+# Время жизни локального справочника номеров до полной пересинхронизации (сек)
+PHONES_TTL = int(os.getenv('PHONES_TTL', 6 * 3600))
+# Интервал фоновой инкрементальной синхронизации (сек)
+PHONES_SYNC_INTERVAL = int(os.getenv('PHONES_SYNC_INTERVAL', 300))
+# Размер страницы и число параллельных запросов при выгрузке клиентов
+PAGE_SIZE = 200
+MAX_CONCURRENT_PAGES = int(os.getenv('YCLIENTS_CONCURRENCY', 5))
+
+# Адрес запроса
+url = f'https://api.yclients.com/api/v1/company/{CID}/clients/search'
+
+# Заголовки запроса
+headers = {
+    'Authorization': f'Bearer {PARTNER_TOKEN}, {USER_TOKEN}',
+    'Accept': 'application/vnd.api.v2+json',
+    'Content-Type': 'application/json'
+}
+
+
+# Приведение номера из YCLIENTS к формату, который вводит пользователь
+def _client_record(client):
+    phone = client.get('phone') or ''
+    return normalize_phone_number(phone) or phone, client.get('id')
+
+
+# Общий HTTP-клиент с keep-alive для всех запросов к YCLIENTS
+_http_client = None
+# Момент, до которого все запросы ждут после ответа 429
+_rate_limited_until = 0.0
+
+
+def get_http_client():
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            headers=headers,
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(max_connections=MAX_CONCURRENT_PAGES,
+                                max_keepalive_connections=MAX_CONCURRENT_PAGES)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
 
-async def get_client_phone_numbers():
-    # Адрес запроса
-    url = f'https://api.yclients.com/api/v1/company/{CID}/clients/search'
 
-    # Заголовки запроса
-    headers = {
-        'Authorization': f'Bearer {PARTNER_TOKEN}, {USER_TOKEN}',
-        'Accept': 'application/vnd.api.v2+json',
-        'Content-Type': 'application/json'
+# Ожидание по заголовку Retry-After, общее для всех параллельных запросов
+async def _wait_rate_limit():
+    delay = _rate_limited_until - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def _retry_after(response, attempt):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return float(2 ** attempt)
+
+
+# Запрос одной страницы клиентов
+@timed('yclients_request')
+async def search_clients(page, page_size=PAGE_SIZE, order_desc=False, filters=None, retries=5):
+    global _rate_limited_until
+    # Тело запроса
+    body = {
+        "page": page,
+        "page_size": page_size,
+        "fields": [
+            "id",
+            "name",
+            "phone"
+        ]
     }
+    if order_desc:
+        body["order_by"] = "id"
+        body["order_by_direction"] = "desc"
+    if filters:
+        body["filters"] = filters
+
+    client = get_http_client()
+    for attempt in range(retries):
+        await _wait_rate_limit()
+
+        # Отправка запроса
+        response = await client.post(url, json=body)
+
+        # Превышен лимит запросов - ждем и повторяем
+        if response.status_code == 429:
+            delay = _retry_after(response, attempt)
+            _rate_limited_until = max(_rate_limited_until, time.monotonic() + delay)
+            logging.warning(f"[search_clients] 429 на странице {page}, ожидание {delay} сек")
+            continue
+
+        # Проверка статуса ответа
+        if response.status_code != 200:
+            raise Exception(f"Ошибка на странице {page}: {response.status_code}, {response.text}")
+
+        return response.json()
+
+    raise Exception(f"Превышен лимит запросов на странице {page}")
+
 
+# Полная выгрузка клиентов: список пар (номер, id клиента).
+# Общее количество берется из первой страницы, остальные запрашиваются параллельно
+async def get_clients():
+    first_page = await search_clients(1)
+    data = first_page['data']
+    clients_list = [_client_record(c) for c in data]
+    if not data:
+        return clients_list
+
+    total_count = (first_page.get('meta') or {}).get('total_count')
+    if total_count:
+        pages_count = -(-total_count // PAGE_SIZE)
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+
+        async def fetch_page(page):
+            async with semaphore:
+                return await search_clients(page)
+
+        pages = await asyncio.gather(*(fetch_page(page) for page in range(2, pages_count + 1)))
+        for clients_data_list in pages:
+            clients_list.extend(_client_record(c) for c in clients_data_list['data'])
+        page = pages_count + 1
+        last_page_full = len(pages[-1]['data'] if pages else data) == PAGE_SIZE
+    else:
+        page = 2
+        last_page_full = len(data) == PAGE_SIZE
+
+    # Клиенты добавились во время выгрузки или meta отсутствует - дочитываем последовательно
+    while last_page_full:
+        data = (await search_clients(page))['data']
+        clients_list.extend(_client_record(c) for c in data)
+        last_page_full = len(data) == PAGE_SIZE
+        page += 1
+
+    return clients_list
+
+
+# Инкрементальная выгрузка: новые клиенты с id больше последнего известного
+async def get_new_clients(last_client_id):
     page = 1
-    page_size = 200
-    numbers_list = []
-    
-    async with httpx.AsyncClient() as client:
-        while True:            
-            # Тело запроса
-            body = {    
-                "page": page,
-                "page_size": page_size,
-                "fields": [
-                    "id",
-                    "name",
-                    "phone"            
-                ]    
-            }
-            
-            try: 
-                # Отправка запроса
-                response = await client.post(url, headers=headers, json=body)
-                
-                # Проверка статуса ответа
-                if response.status_code != 200:
-                    logging.error(f"Ошибка на странице {page}: {response.status_code}, {response.text}")
-                    break
-                
-                clients_data_list = response.json()
-                    
-                # Если нет результатов, прекращаем цикл
-                if not clients_data_list['data']:
-                    break
-                                    
-                phone_numbers = [client['phone'] for client in clients_data_list['data']] 
-                # phone_numbers = phone_numbers = [{'phone': client['phone'], 'record_date': client['record_date']} # Для словаря{'Номер_телефона':'Дата_записи'}
-                #                                  for client in clients_data_list['data']]
-                numbers_list.extend(phone_numbers)
-                
-                # Переходим к следующей странице
-                page += 1 
-
-            except Exception as e:
-                logging.error(f"Ошибка при запросе страницы {page}: {str(e)}")
-                break
-                            
-    return numbers_list   
-        
\ No newline at end of file
+    clients_list = []
+
+    while True:
+        clients_data_list = await search_clients(page, order_desc=True)
+        data = clients_data_list['data']
+        if not data:
+            break
+
+        new_clients = [c for c in data if c.get('id', 0) > last_client_id]
+        clients_list.extend(_client_record(c) for c in new_clients)
+
+        # Страница содержит уже известных клиентов - дальше только старые
+        if len(new_clients) < len(data):
+            break
+        page += 1
+
+    return clients_list
+
+
+# Поиск одного клиента по номеру телефона (при промахе локального справочника)
+async def find_client_by_phone(phone_number):
+    filters = [{"type": "quick_search", "state": {"value": phone_number.lstrip('+')}}]
+    clients_data_list = await search_clients(1, page_size=10, filters=filters)
+
+    found = [_client_record(c) for c in clients_data_list['data']]
+    found = [record for record in found if record[0] == phone_number]
+    if found:
+        await run_db(add_client_phones, found)
+    return bool(found)
+
+
+# Синхронизация локального справочника: полная по истечении TTL, иначе инкрементальная
+async def sync_client_phones():
+    last_full_sync = float(await run_db(get_sync_value, 'phones_full_sync') or 0)
+
+    if time.time() - last_full_sync > PHONES_TTL:
+        started = time.time()
+        clients = await get_clients()
+        await run_db(replace_client_phones, clients)
+        await run_db(set_sync_value, 'phones_full_sync', started)
+        logging.info(f"[sync_client_phones] Полная синхронизация: {len(clients)} номеров")
+    else:
+        clients = await get_new_clients(await run_db(get_max_client_id))
+        if clients:
+            await run_db(add_client_phones, clients)
+        logging.info(f"[sync_client_phones] Инкрементальная синхронизация: {len(clients)} новых номеров")
+
+
+# Фоновая задача синхронизации справочника номеров
+async def client_phones_sync_loop():
+    while True:
+        try:
+            await sync_client_phones()
+        except Exception as e:
+            logging.error(f"[client_phones_sync_loop] Ошибка синхронизации номеров: {e}")
+        await asyncio.sleep(PHONES_SYNC_INTERVAL)
+
+
+# Проверка номера: локальный справочник, при промахе - точечный запрос в YCLIENTS
+@timed('yclients_lookup')
+async def check_client_phone(phone_number):
+    if await run_db(is_client_phone, phone_number):
+        return True
+
+    try:
+        return await find_client_by_phone(phone_number)
+    except Exception as e:
+        logging.error(f"[check_client_phone] Ошибка поиска клиента {phone_number}: {e}")
+        return False